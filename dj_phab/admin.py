@@ -1,5 +1,6 @@
 from django.contrib import admin
-from dj_phab.models import PhabUser, Project, Repository, PullRequest, LastImportTracker
+from dj_phab.models import PhabUser, Project, Repository, PullRequest, ImportShard, \
+                           ImportWatermark
 
 
 class PhabUserAdmin(admin.ModelAdmin):
@@ -31,8 +32,13 @@ class PullRequestAdmin(admin.ModelAdmin):
     filter_horizontal = ['files',]
 
 
-class LastImportTrackerAdmin(admin.ModelAdmin):
-    list_display = ['last_import_time',]
+class ImportShardAdmin(admin.ModelAdmin):
+    list_display = ['__unicode__', 'status', 'attempts', 'claimed_by', 'claimed_at',]
+    list_filter = ['status',]
+
+
+class ImportWatermarkAdmin(admin.ModelAdmin):
+    list_display = ['entity', 'modified', 'cursor',]
     list_display_links = []
 
 
@@ -40,4 +46,5 @@ admin.site.register(PhabUser, PhabUserAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(Repository, RepositoryAdmin)
 admin.site.register(PullRequest, PullRequestAdmin)
-admin.site.register(LastImportTracker, LastImportTrackerAdmin)
+admin.site.register(ImportShard, ImportShardAdmin)
+admin.site.register(ImportWatermark, ImportWatermarkAdmin)
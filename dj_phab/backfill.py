@@ -0,0 +1,124 @@
+"""
+Multi-process backfill of diffs, sharded by diff ID
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from django.db import connections
+from dj_phab.models import ImportShard
+
+
+# Attempts at a shard before it's marked as failed
+MAX_ATTEMPTS = 3
+
+# Seconds before a failed shard is first retried; doubles with every further retry
+RETRY_DELAY = 30
+
+# Seconds a worker waits before looking for shards again while other workers' shards are
+# in progress or failed shards are waiting to be retried
+POLL_INTERVAL = 5
+
+
+def get_unfinished_shards():
+    """
+    @return QuerySet Shards still to be imported
+    """
+    return ImportShard.objects.filter(
+        status__in=[ImportShard.STATUS.pending, ImportShard.STATUS.claimed])
+
+
+def plan_shards(api, shard_size):
+    """
+    Split the IDs of all diffs into shards of ``shard_size`` IDs.  Shards are only
+    planned once: if an earlier backfill planned them, they're kept instead, so that the
+    backfill carries on from where it stopped and isn't repeated once it's done.  To
+    backfill again, delete the shards.
+
+    @param ConduitAPI api
+    @param int shard_size Number of diff IDs per shard
+    @return int Number of shards left to import
+    """
+    if ImportShard.objects.exists():
+        return get_unfinished_shards().count()
+
+    latest_id = api.fetch_latest_pull_request_id()
+    if latest_id is None:
+        return 0
+
+    shards = [ImportShard(start_id=start_id, end_id=min(start_id + shard_size, latest_id + 1))
+              for start_id in range(1, latest_id + 1, shard_size)]
+    ImportShard.objects.bulk_create(shards)
+    return len(shards)
+
+
+def run_worker(runner, name, claim_timeout, retry_delay=RETRY_DELAY, sleep=time.sleep):
+    """
+    Claim and import shards until every shard is imported or has failed, waiting for
+    shards still in progress or waiting to be retried.  Failed shards are retried up to
+    `MAX_ATTEMPTS` times.
+
+    @param ImportRunner runner
+    @param str name Name of the worker, recorded on the shards it claims
+    @param int claim_timeout Seconds after which an unrenewed claim expires
+    @param float retry_delay Seconds before a failed shard is first retried
+    @param callable sleep Function used to wait for shards
+    @return int Number of shards imported
+    """
+    imported = 0
+    while True:
+        shard = ImportShard.claim(name, claim_timeout)
+        if shard is None:
+            if not get_unfinished_shards().exists():
+                return imported
+            sleep(POLL_INTERVAL)
+            continue
+
+        logging.info('%s importing shard %s' % (name, shard))
+        try:
+            runner.import_shard(shard)
+        except Exception:
+            logging.exception('%s failed shard %s' % (name, shard))
+            shard.fail(traceback.format_exc(), MAX_ATTEMPTS, retry_delay)
+            # The runner's caches may hold rows the rollback just removed
+            runner.reset_caches()
+            continue
+
+        shard.finish()
+        imported += 1
+
+
+def run_backfill(make_runner, processes, claim_timeout):
+    """
+    Import every unfinished shard using ``processes`` worker processes.  Each process opens
+    its own DB connection and gets its own Conduit client, by calling ``make_runner``.
+
+    @param callable make_runner Returns a new ImportRunner; called in each worker process
+    @param int processes Number of worker processes
+    @param int claim_timeout Seconds after which an unrenewed claim expires
+    @return bool Whether every shard was imported
+    """
+    # Forked processes mustn't share the parent's DB connections
+    for connection in connections.all():
+        connection.close()
+
+    workers = [multiprocessing.Process(target=_run_worker_process,
+                                       args=(make_runner, claim_timeout))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return not ImportShard.objects.exclude(status=ImportShard.STATUS.done).exists()
+
+
+def _run_worker_process(make_runner, claim_timeout):
+    name = u"%s:%s" % (socket.gethostname(), os.getpid())
+    try:
+        run_worker(make_runner(), name, claim_timeout)
+    finally:
+        for connection in connections.all():
+            connection.close()
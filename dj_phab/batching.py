@@ -0,0 +1,62 @@
+"""
+Adaptive page sizing for paginated Conduit calls
+"""
+import logging
+
+
+class AdaptiveBatchSize(object):
+    """
+    Picks the number of records to request per page from how long previous pages took
+    and how large they were, aiming for pages that take about ``target_seconds`` to fetch
+    and are no bigger than ``max_bytes``.  The size changes by at most a factor of 2 per
+    page and always stays within ``min_size`` and ``max_size``.
+    """
+
+    def __init__(self, initial_size, min_size=10, max_size=500, target_seconds=2.0,
+                 max_bytes=4 * 1024 * 1024, **kwargs):
+        """
+        @param int initial_size Size of the first page
+        @param int min_size Smallest page size to request
+        @param int max_size Largest page size to request
+        @param float target_seconds Desired time to fetch a page
+        @param int max_bytes Largest desired response size
+        """
+        super(AdaptiveBatchSize, self).__init__(**kwargs)
+        if min_size > max_size:
+            raise ValueError('min_size must not be greater than max_size.')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.size = self.clamp(initial_size)
+
+    def clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def record(self, record_count, seconds, response_bytes):
+        """
+        Adjust the page size based on an observed page
+
+        @param int record_count Number of records in the page
+        @param float seconds Time taken to fetch the page
+        @param int response_bytes Size of the response
+        @return int New page size
+        """
+        if not record_count:
+            # nothing to learn from an empty page
+            return self.size
+
+        ideal = float(self.max_size)
+        if seconds > 0:
+            ideal = min(ideal, self.target_seconds * record_count / seconds)
+        if response_bytes > 0:
+            ideal = min(ideal, float(self.max_bytes) * record_count / response_bytes)
+
+        new_size = self.clamp(max(self.size / 2.0, min(self.size * 2.0, ideal)))
+        if new_size != self.size:
+            logging.info('batch size changed from %s to %s after %s records took %.2f seconds '
+                         '(%s bytes)' % (self.size, new_size, record_count, seconds,
+                                         response_bytes))
+            self.size = new_size
+
+        return self.size
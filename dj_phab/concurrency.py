@@ -0,0 +1,194 @@
+"""
+Helpers for running network-bound work concurrently during imports
+"""
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from django.utils import six
+from django.utils.six.moves import queue as Queue
+
+
+# Sentinel marking the end of a prefetched iterable
+_EXHAUSTED = object()
+
+# How often a prefetching thread waiting for room checks whether its consumer has stopped
+PREFETCH_POLL_SECONDS = 0.1
+
+
+def map_concurrently(func, items, workers=1):
+    """
+    Apply ``func`` to every item in ``items`` using a bounded pool of worker threads,
+    returning results in the same order as ``items``.  With ``workers`` <= 1 this is a
+    plain serial ``map``, so callers don't need a separate code path for that case.
+
+    Only use this for work that doesn't touch the DB: Django connections are per-thread,
+    so any writes made from a worker would happen outside the caller's transaction.
+
+    @param callable func Function of one argument
+    @param iterable items Arguments to pass to ``func``
+    @param int workers Maximum number of threads to run at once
+    @return list Results of ``func`` for each item, in order
+    """
+    items = list(items)
+
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_stream(func, items, workers=1, depth=1):
+    """
+    Like `map_concurrently`, but for a stream of items: ``items`` is consumed lazily, on
+    the caller's thread, and no more than ``workers + depth`` calls are running or waiting
+    to be collected at once.  A slow consumer therefore holds back the producer rather than
+    letting results pile up in memory.  Results are yielded in the same order as ``items``,
+    and exceptions are re-raised when the failed item's result is reached.
+
+    Even with one worker, ``func`` runs on a separate thread from the consumer, so the two
+    overlap.
+
+    @param callable func Function of one argument
+    @param iterable items Arguments to pass to ``func``
+    @param int workers Maximum number of threads to run at once
+    @param int depth Maximum number of results to hold beyond those being worked on
+    @return generator Results of ``func`` for each item, in order
+    """
+    workers = max(1, workers)
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers + depth:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def measure(iterable, stats, size=len):
+    """
+    Iterate over ``iterable``, recording in ``stats`` how long each item took to produce
+
+    @param iterable iterable
+    @param StageStats stats
+    @param callable size Returns the number of records in an item
+    @return generator
+    """
+    iterator = iter(iterable)
+    while True:
+        started = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.record(size(item), time.time() - started)
+        yield item
+
+
+class StageStats(object):
+    """
+    Throughput counters for one stage of a pipeline.  Seconds are summed over all of the
+    stage's threads, so the rate is per thread: the stage with the lowest rate relative to
+    its number of threads is the bottleneck.  Safe to update from several threads.
+    """
+
+    def __init__(self, name, **kwargs):
+        """
+        @param str name
+        """
+        super(StageStats, self).__init__(**kwargs)
+        self.name = name
+        self.batches = 0
+        self.records = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, records, seconds):
+        """
+        @param int records Number of records in the batch processed
+        @param float seconds Time spent processing it
+        """
+        with self._lock:
+            self.batches += 1
+            self.records += records
+            self.seconds += seconds
+
+    @property
+    def rate(self):
+        """
+        @return float Records processed per second
+        """
+        if not self.seconds:
+            return 0.0
+        return self.records / self.seconds
+
+    def get_summary(self):
+        """
+        @return str
+        """
+        return u"%s: %s records in %s batches, %.2f seconds (%.1f records/second)" % \
+               (self.name.capitalize(), self.records, self.batches, self.seconds, self.rate)
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterate over ``iterable`` while a background thread reads up to ``depth`` items ahead,
+    so that e.g. the next page of API results is being fetched while the current one is
+    being processed.  Exceptions raised while reading are re-raised in the consumer.  If
+    the consumer stops early, the background thread stops once it's done reading the item
+    in progress.
+
+    @param iterable iterable
+    @param int depth Maximum number of items to read ahead of the consumer
+    @return generator
+    """
+    buffered = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(value):
+        # wait for room in the queue, giving up if the consumer has gone away
+        while not stopped.is_set():
+            try:
+                buffered.put(value, timeout=PREFETCH_POLL_SECONDS)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((_EXHAUSTED, None))
+
+    producer = threading.Thread(target=produce)
+    # don't keep the process alive if the consumer stops iterating early
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item, exc_info = buffered.get()
+            if exc_info:
+                six.reraise(*exc_info)
+            if item is _EXHAUSTED:
+                break
+            yield item
+    finally:
+        stopped.set()
@@ -1,38 +1,303 @@
+import calendar
+import json
 import logging
-import socket
 import time
+from dj_phab.concurrency import map_concurrently
+from dj_phab.ratelimit import RateLimiter
+from dj_phab.retry import RetryPolicy
+from dj_phab.transport import PhabricatorTransport
+from dj_phab.util import chunks
+
+
+PAGINATION_OFFSET = 'offset'
+PAGINATION_CURSOR = 'cursor'
+
+
+def to_timestamp(date):
+    """
+    Convert a datetime to a UNIX timestamp as used by Conduit.  Naive datetimes are
+    assumed to be in local time.
+
+    @param datetime.datetime date
+    @return int
+    """
+    if date.tzinfo is not None:
+        return calendar.timegm(date.utctimetuple())
+    return int(time.mktime(date.timetuple()))
+
+
+def get_feed_stories(response):
+    """
+    @param dict|list response A `feed.query` result, which is keyed by story PHID
+    @return list<dict> The stories, newest first
+    """
+    if isinstance(response, dict):
+        response = response.values()
+    return sorted(response, key=lambda story: int(story['chronologicalKey']), reverse=True)
+
+
+def get_story_object_phid(story):
+    """
+    @param dict story A `feed.query` story
+    @return str|None PHID of the object the story is about.  The 'data' view nests it in
+        the story's data, which is an empty list for stories without any
+    """
+    return story.get('objectPHID') or (story.get('data') or {}).get('objectPHID')
+
+
+class Page(list):
+    """
+    A page of records, with the position to resume paging from after it
+    """
+
+    def __init__(self, records, position=None):
+        """
+        @param list records
+        @param str position Offset or cursor of the next page
+        """
+        super(Page, self).__init__(records)
+        self.position = position
 
 
 class ConduitAPI(object):
     # @TODO: convert Python-formatted args to JSON-formatted ones
-    # @TODO: handle failure cases
     """
     Wrapper around `python-phabricator` API client to provide access to Conduit
     data with syntax less dependent on Conduit.
     """
 
-    def __init__(self, phabricator, batch_size=50, **kwargs):
+    def __init__(self, phabricator, batch_size=50, pagination=PAGINATION_OFFSET, workers=1,
+                 retry_policy=None, rate_limiter=None, batch_sizer=None, transport=None,
+                 **kwargs):
         """
         @param Phabricator phabricator A python-phabricator API client
         @param int batch_size Limit number of records returned in any one request
+        @param 'offset'|'cursor' pagination How to page through diffs: 'offset' uses
+            `differential.query` with limit/offset; 'cursor' uses
+            `differential.revision.search` cursors, which requires a newer Phabricator
+        @param int workers Maximum number of pages to fetch concurrently
+        @param RetryPolicy retry_policy Applied to every Conduit call; defaults to
+            `RetryPolicy()`
+        @param RateLimiter rate_limiter Shared by every Conduit call, including retries and
+            calls from worker threads; defaults to no limit
+        @param AdaptiveBatchSize batch_sizer If given, picks the page size used to fetch
+            diffs instead of `batch_size`
+        @param transport Sends requests to Conduit, e.g. a `PooledHTTPTransport`;
+            defaults to sending them through ``phabricator`` itself
         """
         # @TODO: update definitions
         super(ConduitAPI, self).__init__(**kwargs)
         self.phabricator = phabricator
         self.batch_size = batch_size
+        if pagination not in (PAGINATION_OFFSET, PAGINATION_CURSOR):
+            raise ValueError('Pagination must be one of "%s", "%s".' %
+                             (PAGINATION_OFFSET, PAGINATION_CURSOR))
+        self.pagination = pagination
+        self.workers = workers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.batch_sizer = batch_sizer
+        self.transport = transport or PhabricatorTransport(phabricator)
+
+    def call(self, method, **params):
+        """
+        Call a Conduit method, applying the retry policy and rate limits
 
-    def fetch_users(self, **kwargs):
-        return self.phabricator.user.query(**kwargs).response
+        @param str method Conduit method name, e.g. 'differential.query'
+        @return any The method's result
+        """
+        return self.call_timed(method, **params)[0]
+
+    def call_timed(self, method, **params):
+        """
+        Like `call`, but also return how long the request that succeeded took.  Time spent
+        waiting for the rate limiter or between retries is left out, so that it doesn't
+        look like a slow page to the adaptive batch sizer.
+
+        @param str method Conduit method name, e.g. 'differential.query'
+        @return tuple(any, float) The method's result and the request's duration in seconds
+        """
+        def request():
+            self.rate_limiter.acquire(method)
+            started = time.time()
+            result = self.transport.call(method, params)
+            return result, time.time() - started
 
-    def fetch_projects(self, **kwargs):
-        # @TODO: handle case where N > 100, since phab returns these batched
-        response = self.phabricator.project.query(**kwargs).response
-        return response.get('data', {}).values()
+        return self.retry_policy.call(request)
 
-    def fetch_repositories(self, **kwargs):
-        return self.phabricator.repository.query(**kwargs).response
+    def fetch_users(self, modified_since=None, **kwargs):
+        """
+        @param datetime.datetime modified_since If not None, only users modified after this
+            date will be returned
+        @return list<dict>
+        """
+        if modified_since is not None:
+            kwargs['phids'] = self.fetch_modified_phids('user.search', modified_since)
+            if not kwargs['phids']:
+                return []
+
+        def fetch_page(offset, limit):
+            return self.call('user.query', offset=offset, limit=limit, **kwargs)
+
+        return self._fetch_all_by_offset(fetch_page)
+
+    def fetch_projects(self, modified_since=None, **kwargs):
+        """
+        @param datetime.datetime modified_since If not None, only projects modified after
+            this date will be returned
+        @return list<dict>
+        """
+        if modified_since is not None:
+            kwargs['phids'] = self.fetch_modified_phids('project.search', modified_since)
+            if not kwargs['phids']:
+                return []
+
+        def fetch_page(offset, limit):
+            response = self.call('project.query', offset=offset, limit=limit, **kwargs)
+            # PHP encodes an empty result, e.g. a page past the end, as a list
+            data = response.get('data') or {}
+            return list(data.values()) if isinstance(data, dict) else []
+
+        return self._fetch_all_by_offset(fetch_page)
+
+    def fetch_repositories(self, modified_since=None, **kwargs):
+        """
+        @param datetime.datetime modified_since If not None, only repositories modified
+            after this date will be returned
+        @return list<dict>
+        """
+        if modified_since is not None:
+            kwargs['phids'] = self.fetch_modified_phids('diffusion.repository.search',
+                                                        modified_since)
+            if not kwargs['phids']:
+                return []
+
+        def fetch_page(after, limit):
+            if after is not None:
+                kwargs['after'] = after
+            return self.call('repository.query', limit=limit, **kwargs)
+
+        return self._fetch_all_by_id_cursor(fetch_page)
+
+    def fetch_modified_phids(self, method, modified_since):
+        """
+        Page through a ``*.search`` method for the PHIDs of objects modified since a date.
+        The older ``*.query`` methods can't filter by date modified, but they return the
+        fields we import, so the objects themselves are then fetched from those by PHID.
+
+        @param str method e.g. 'user.search'
+        @param datetime.datetime modified_since
+        @return list<str>
+        """
+        phids = []
+        after = None
+        while True:
+            options = {
+                'constraints': {'modifiedStart': to_timestamp(modified_since)},
+                'limit': self.batch_size,
+            }
+            if after:
+                options['after'] = after
+
+            results = self.call(method, **options)
+            phids.extend(item['phid'] for item in results.get('data', []))
+
+            after = (results.get('cursor') or {}).get('after')
+            if not after:
+                return phids
+
+    def _fetch_all_by_offset(self, fetch_page):
+        """
+        Fetch every page of a limit/offset-paginated method.  The first page is fetched on
+        its own; if it's full, following pages are fetched `workers` at a time until one
+        comes back short.
+
+        @param callable fetch_page Takes an offset and limit; returns a list of records
+        @return list<dict>
+        """
+        limit = self.batch_size
+        records = fetch_page(0, limit)
+        if len(records) < limit:
+            return records
+
+        offset = limit
+        while True:
+            offsets = [offset + limit * i for i in range(max(self.workers, 1))]
+            pages = map_concurrently(lambda page_offset: fetch_page(page_offset, limit),
+                                     offsets, self.workers)
+            for page in pages:
+                records.extend(page)
+                if len(page) < limit:
+                    return records
+            offset = offsets[-1] + limit
+
+    def _fetch_all_by_id_cursor(self, fetch_page):
+        """
+        Fetch every page of a method paginated with an `after` cursor set to the ID of the
+        last record on the previous page.  Pages have to be fetched one after the other.
+
+        @param callable fetch_page Takes a cursor (None for the first page) and limit;
+            returns a list of records
+        @return list<dict>
+        """
+        limit = self.batch_size
+        records = []
+        after = None
+
+        while True:
+            page = fetch_page(after, limit)
+            records.extend(page)
+            if len(page) < limit:
+                return records
+            after = page[-1]['id']
+
+    def get_page_size(self):
+        """
+        @return int Number of diffs to request in the next page
+        """
+        if self.batch_sizer:
+            return self.batch_sizer.size
+        return self.batch_size
+
+    def record_page(self, records, seconds):
+        """
+        Let the adaptive batch sizer, if any, learn from a fetched page of diffs
+
+        @param list<dict> records
+        @param float seconds Time taken to fetch the page
+        """
+        if self.batch_sizer:
+            self.batch_sizer.record(len(records), seconds, len(json.dumps(records)))
 
     def fetch_pull_requests(self, modified_since=None, **kwargs):
+        """
+        Fetch all diffs at once.  See `iter_pull_requests`.
+
+        @param datetime.datetime modified_since If not None, only diffs modified after this
+            date will be returned
+        @return list<dict>
+        """
+        pull_requests = []
+        for page in self.iter_pull_requests(modified_since, **kwargs):
+            pull_requests.extend(page)
+        return pull_requests
+
+    def iter_pull_requests(self, modified_since=None, position=None, **kwargs):
+        """
+        Yield diffs in batches as soon as each batch is fetched, so callers only need to
+        hold one batch in memory at a time.
+
+        @param datetime.datetime modified_since If not None, only diffs modified after this
+            date will be returned
+        @param str position If not None, resume from the `Page.position` of a page yielded
+            by an earlier call with the same arguments
+        @return generator<Page<dict>>
+        """
+        if self.pagination == PAGINATION_CURSOR:
+            return self._iter_pull_requests_by_cursor(modified_since, position, **kwargs)
+        return self._iter_pull_requests_by_offset(modified_since, position, **kwargs)
+
+    def _iter_pull_requests_by_offset(self, modified_since=None, position=None, **kwargs):
         """
         This is a mess because you can ask Conduit to sort returned data by date modified
         (descending) but you can't filter by the field.  Plus we have enough total data
@@ -41,36 +306,24 @@ class ConduitAPI(object):
 
         @param datetime.datetime modified_since If not None, only diffs modified after this
             date will be returned
-        @return list<dict>
+        @param str position Offset to start from
+        @return generator<Page<dict>>
         """
-        pull_requests = []
         options = kwargs
-        options['limit'] = self.batch_size
-        options['offset'] = 0
+        options['offset'] = int(position or 0)
 
         # If since is not None, order by date modified
         if modified_since:
             # we need a UNIX timestamp form of the date
-            min_timestamp = int(time.mktime(modified_since.timetuple()))
+            min_timestamp = to_timestamp(modified_since)
             options['order'] = 'order-modified'
 
         # I wish Python supported do...while
         # fetch in batches until no data or date modified < modified_since
         while True:
-            # Make 5 attempts to fetch data
-            attempt_count = 0
-            while True:
-                try:
-                    new_data = self.phabricator.differential.query(**options).response
-                except socket.timeout:
-                    if attempt_count >= 4:
-                        raise
-                    else:
-                        attempt_count += 1
-                else:
-                    break
-                finally:
-                    logging.debug('connection attempt %s for offset %s' % (attempt_count, options['offset']))
+            options['limit'] = self.get_page_size()
+            new_data, seconds = self.call_timed('differential.query', **options)
+            self.record_page(new_data, seconds)
 
             if modified_since:
                 # Remove any items that predate our min date modified
@@ -79,15 +332,206 @@ class ConduitAPI(object):
             # hang onto the data if we have any
             if len(new_data):
                 logging.info('fetched %s diffs' % len(new_data))
-                pull_requests.extend(new_data)
                 # update offset so next fetch gets the next batch
                 options['offset'] += len(new_data)
+                yield Page(new_data, str(options['offset']))
 
-            if (len(new_data) < self.batch_size):
+            if (len(new_data) < options['limit']):
                 # we're out of data. stop fetching
                 break
 
+    def _iter_pull_requests_by_cursor(self, modified_since=None, position=None, **kwargs):
+        """
+        Page through `differential.revision.search` by cursor, letting the server filter
+        by date modified.  Unlike offsets, cursors stay cheap for deep pages and don't
+        skip or repeat rows when diffs are modified mid-scan.
+
+        `revision.search` doesn't return everything we import (e.g. line counts, diffs
+        and commits), so the full records for each page are then fetched by ID from
+        `differential.query`.
+
+        @param datetime.datetime modified_since If not None, only diffs modified after this
+            date will be returned
+        @param str position Cursor to start after
+        @return generator<Page<dict>>
+        """
+        constraints = kwargs.pop('constraints', {})
+        for ids, after, seconds in self._search_revisions(modified_since, position,
+                                                          constraints):
+            new_data, query_seconds = self.call_timed('differential.query', ids=ids,
+                                                      limit=len(ids), **kwargs)
+            self.record_page(new_data, seconds + query_seconds)
+            logging.info('fetched %s diffs' % len(new_data))
+            yield Page(new_data, after)
+
+    def _search_revisions(self, modified_since=None, position=None, constraints=None):
+        """
+        Page through the IDs of diffs from `differential.revision.search`
+
+        @param datetime.datetime modified_since
+        @param str position Cursor to start after
+        @param dict constraints Other constraints on the search
+        @return generator<tuple(list<int>, str, float)> The IDs in each page of diffs,
+            the cursor after it, and how long the request took
+        """
+        constraints = dict(constraints or {})
+        if modified_since:
+            constraints['modifiedStart'] = to_timestamp(modified_since)
+
+        after = position
+        while True:
+            options = {
+                'constraints': constraints,
+                'order': 'updated',
+                'limit': self.get_page_size(),
+            }
+            if after:
+                options['after'] = after
+
+            results, seconds = self.call_timed('differential.revision.search', **options)
+            ids = [int(revision['id']) for revision in results.get('data', [])]
+            after = (results.get('cursor') or {}).get('after')
+
+            if ids:
+                yield ids, after, seconds
+
+            if not after:
+                # no more pages
+                break
+
+    def iter_pull_request_ids(self, modified_since=None):
+        """
+        Yield the IDs of diffs modified since ``modified_since``, a page at a time.  With
+        cursor pagination only the IDs are fetched; `differential.query` can't list IDs
+        alone, so with offset pagination whole pages of diffs are.
+
+        @param datetime.datetime modified_since If not None, only diffs modified after this
+            date will be returned
+        @return generator<list<int>>
+        """
+        if self.pagination == PAGINATION_CURSOR:
+            for ids, after, seconds in self._search_revisions(modified_since):
+                yield ids
+        else:
+            for page in self._iter_pull_requests_by_offset(modified_since):
+                yield [int(diff['id']) for diff in page]
+
+    def fetch_pull_requests_by_id(self, ids, **kwargs):
+        """
+        @param list<int> ids
+        @return list<dict> The diffs that exist and can be seen
+        """
+        return self.call('differential.query', ids=ids, limit=len(ids), **kwargs)
+
+    def fetch_latest_pull_request_id(self):
+        """
+        @return int|None ID of the most recently created diff, or None if there are none
+        """
+        diffs = self.call('differential.query', order='order-created', limit=1)
+        if not diffs:
+            return None
+        return int(diffs[0]['id'])
+
+    def iter_pull_requests_by_id(self, start_id, end_id, **kwargs):
+        """
+        Yield the diffs with IDs from ``start_id`` up to but not including ``end_id``, a
+        page of IDs at a time.  IDs of diffs that don't exist or can't be seen are skipped.
+
+        @param int start_id
+        @param int end_id
+        @return generator<Page<dict>> The position of each page is the next ID to fetch
+        """
+        next_id = start_id
+        while next_id < end_id:
+            ids = list(range(next_id, min(next_id + self.get_page_size(), end_id)))
+            new_data, seconds = self.call_timed('differential.query', ids=ids,
+                                                limit=len(ids), **kwargs)
+            self.record_page(new_data, seconds)
+            next_id = ids[-1] + 1
+
+            if new_data:
+                logging.info('fetched %s diffs' % len(new_data))
+                yield Page(new_data, str(next_id))
+
+    def fetch_pull_requests_by_phid(self, phids, **kwargs):
+        """
+        @param list<str> phids
+        @return list<dict> The diffs that exist and can be seen, fetched a page at a time
+        """
+        pull_requests = []
+        for page in chunks(phids, self.batch_size):
+            pull_requests.extend(self.call('differential.query', phids=page, limit=len(page),
+                                           **kwargs))
         return pull_requests
 
+    def fetch_latest_feed_key(self):
+        """
+        @return str|None Chronological key of the newest feed story, or None if there are
+            none
+        """
+        stories = get_feed_stories(self.call('feed.query', limit=1, view='data'))
+        if not stories:
+            return None
+        return stories[0]['chronologicalKey']
+
+    def iter_feed(self, after):
+        """
+        Yield the feed stories newer than the chronological key ``after``, oldest first, a
+        page at a time.  `feed.query` lists stories newest first, so newer stories are
+        those "before" a key.
+
+        @param str after
+        @return generator<Page<dict>> The position of each page is the key of its newest
+            story
+        """
+        while True:
+            limit = self.batch_size
+            stories = get_feed_stories(self.call('feed.query', before=after, limit=limit,
+                                                 view='data'))
+            stories.reverse()
+            if stories:
+                after = stories[-1]['chronologicalKey']
+                logging.info('fetched %s feed stories' % len(stories))
+                yield Page(stories, after)
+
+            if len(stories) < limit:
+                break
+
     def fetch_files(self, pull_request_id, **kwargs):
-        return self.phabricator.differential.getcommitpaths(revision_id=pull_request_id).response
+        return self.call('differential.getcommitpaths', revision_id=pull_request_id)
+
+    def fetch_files_for_pull_requests(self, pull_requests):
+        """
+        Fetch the changed paths of many diffs in a single `differential.querydiffs` request,
+        rather than one `differential.getcommitpaths` request per diff.  As with
+        `getcommitpaths`, paths are taken from the latest version of each diff.
+
+        @param list<dict> pull_requests Diffs as returned by `fetch_pull_requests`
+        @return dict<int, list<str>> Paths keyed by diff (revision) ID
+        """
+        files = {}
+        latest_diff_ids = []
+
+        for pull_request in pull_requests:
+            revision_id = int(pull_request['id'])
+            if pull_request.get('diffs'):
+                files[revision_id] = []
+                latest_diff_ids.append(max(int(diff_id) for diff_id in pull_request['diffs']))
+            else:
+                # without a known diff ID we'd have to fetch every version of the diff
+                files[revision_id] = self.fetch_files(revision_id)
+
+        if latest_diff_ids:
+            response = self.call('differential.querydiffs', ids=latest_diff_ids)
+            # PHP serializes an empty result as a list rather than a dict
+            diffs = response.values() if isinstance(response, dict) else response
+
+            for diff in diffs:
+                paths = files.setdefault(int(diff['revisionID']), [])
+                for change in diff.get('changes', []):
+                    # deleted files only have an old path
+                    path = change.get('currentPath') or change.get('oldPath')
+                    if path and path not in paths:
+                        paths.append(path)
+
+        return files
@@ -0,0 +1,101 @@
+"""
+Long-running import that polls Phabricator for changes
+"""
+import logging
+import random
+import signal
+import threading
+import time
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from dj_phab.models import ImportWatermark
+
+
+class ImportDaemon(object):
+    """
+    Imports changes every ``interval`` seconds, give or take ``jitter``, until stopped by
+    SIGTERM or SIGINT.  The same `ImportRunner` is used for every poll, so its Conduit
+    connections and caches stay warm.  Stopping waits for the poll in progress to finish.
+    """
+
+    def __init__(self, runner, interval=60, jitter=0.1, refresh_interval=3600,
+                 clock=time.time, **kwargs):
+        """
+        @param ImportRunner runner
+        @param float interval Seconds between polls
+        @param float jitter Fraction of ``interval`` by which each wait randomly varies, so
+            that several daemons don't all poll at once
+        @param float refresh_interval Seconds between refetches of all users, projects and
+            repositories
+        @param callable clock Returns the current time in seconds
+        """
+        super(ImportDaemon, self).__init__(**kwargs)
+        self.runner = runner
+        self.interval = interval
+        self.jitter = jitter
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.last_refresh = None
+        self.stopping = threading.Event()
+
+    def get_delay(self):
+        """
+        @return float Seconds to wait before the next poll
+        """
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def stop(self, *args):
+        """
+        Stop after the poll in progress, if any.  Can be used as a signal handler.
+        """
+        logging.info('import daemon stopping')
+        self.stopping.set()
+
+    def poll(self):
+        """
+        Import everything modified since the last import
+        """
+        started = timezone.now()
+        now = self.clock()
+        refresh = self.last_refresh is None or now - self.last_refresh >= self.refresh_interval
+
+        # Like a request, a poll shouldn't use a connection the DB may have closed
+        close_old_connections()
+        try:
+            with transaction.atomic():
+                watermarks = ImportWatermark.get_watermarks()
+                self.runner.poll(watermarks.get(ImportWatermark.PULL_REQUESTS), refresh,
+                                 watermarks)
+                # Anything modified during the poll is picked up by the next one
+                if refresh:
+                    ImportWatermark.update_watermarks(started)
+                else:
+                    ImportWatermark.update_watermarks(started, [ImportWatermark.PULL_REQUESTS])
+        except Exception:
+            # The runner's caches may hold rows the rollback just removed
+            self.runner.reset_caches()
+            raise
+        finally:
+            close_old_connections()
+
+        if refresh:
+            self.last_refresh = now
+        for line in self.runner.get_summary():
+            logging.info(line)
+
+    def run(self):
+        """
+        Poll until stopped.  A failed poll is logged and retried at the next interval.
+        """
+        handlers = dict((signum, signal.signal(signum, self.stop))
+                        for signum in (signal.SIGTERM, signal.SIGINT))
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.poll()
+                except Exception:
+                    logging.exception('import failed; retrying at the next poll')
+                self.stopping.wait(self.get_delay())
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
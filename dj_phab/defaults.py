@@ -16,8 +16,67 @@ DIFF_SIZES = {
 }
 
 
+# Retry and circuit breaker configuration for Conduit calls made during imports
+IMPORT_RETRY = {
+    # total attempts per call, including the first
+    'max_attempts': 5,
+    # retries wait a random time up to base_delay * 2 ^ (retry number - 1) seconds...
+    'base_delay': 0.5,
+    # ...but never more than max_delay seconds
+    'max_delay': 30,
+    # after this many consecutive failed calls, stop calling Conduit...
+    'failure_threshold': 10,
+    # ...for this many seconds
+    'reset_timeout': 60,
+}
+
+
+# Maximum Conduit calls per second during imports, keyed by method name or 'default' for
+# all other methods.  Methods without a limit aren't limited.
+IMPORT_RATE_LIMITS = {}
+
+
+# Bounds and targets used to pick the number of diffs fetched per page, if adaptive batch
+# sizing is turned on by setting IMPORT_ADAPTIVE_BATCH
+IMPORT_ADAPTIVE_BATCH = {
+    'min_size': 10,
+    'max_size': 500,
+    # aim for pages that take this many seconds to fetch...
+    'target_seconds': 2.0,
+    # ...and are no bigger than this many bytes
+    'max_bytes': 4 * 1024 * 1024,
+}
+
+
+# Threads per stage and pages queued between stages, if pipelined imports of diffs are
+# turned on by setting IMPORT_PIPELINE
+IMPORT_PIPELINE = {
+    # threads fetching changed files
+    'fetch_workers': 2,
+    # threads converting records
+    'map_workers': 1,
+    # pages held between one stage and the next
+    'queue_size': 2,
+}
+
+
 IMPORT_BATCH_SIZE = 50
 
+# How to page through diffs: 'offset' (differential.query) or 'cursor'
+# (differential.revision.search, which requires a newer Phabricator)
+IMPORT_PAGINATION = 'offset'
+
+# Whether to fetch changed files for a whole batch of diffs in one request
+# (differential.querydiffs) rather than one request per diff (differential.getcommitpaths)
+IMPORT_BATCH_FILES = True
+
+# Number of threads used to fetch data from Conduit concurrently during imports
+IMPORT_WORKERS = 1
+
+# Seconds after which a backfill shard claimed by a worker that has stopped renewing its
+# claim (e.g. because it crashed) can be claimed by another worker
+IMPORT_CLAIM_TIMEOUT = 600
+
 GRANULARITIES = ['year', 'month', 'week', 'day']
 
 
@@ -32,6 +91,62 @@ def get_diff_sizes():
     diff_sizes.update(getattr(settings, 'PHAB_STATS', {}).get('DIFF_SIZES', {}))
     return diff_sizes
 
+def get_retry_settings():
+    """
+    Return default retry settings updated with any settings overrides
+
+    @return dict retry settings updated with any settings overrides
+    """
+    retry_settings = {}
+    retry_settings.update(IMPORT_RETRY)
+    retry_settings.update(getattr(settings, 'PHAB_STATS', {}).get('IMPORT_RETRY', {}))
+    return retry_settings
+
+def get_rate_limits():
+    """
+    Return default Conduit rate limits updated with any settings overrides
+
+    @return dict calls per second keyed by Conduit method name
+    """
+    rate_limits = {}
+    rate_limits.update(IMPORT_RATE_LIMITS)
+    rate_limits.update(getattr(settings, 'PHAB_STATS', {}).get('IMPORT_RATE_LIMITS', {}))
+    return rate_limits
+
+def get_adaptive_batch_settings():
+    """
+    Return default adaptive batch sizing settings updated with any settings overrides,
+    or None if adaptive batch sizing isn't turned on
+
+    @return dict|None adaptive batch sizing settings
+    """
+    overrides = getattr(settings, 'PHAB_STATS', {}).get('IMPORT_ADAPTIVE_BATCH')
+    if overrides is None or overrides is False:
+        return None
+
+    adaptive_settings = {}
+    adaptive_settings.update(IMPORT_ADAPTIVE_BATCH)
+    if overrides is not True:
+        adaptive_settings.update(overrides)
+    return adaptive_settings
+
+def get_pipeline_settings():
+    """
+    Return default pipelined import settings updated with any settings overrides, or None
+    if pipelined imports aren't turned on
+
+    @return dict|None pipeline settings
+    """
+    overrides = getattr(settings, 'PHAB_STATS', {}).get('IMPORT_PIPELINE')
+    if overrides is None or overrides is False:
+        return None
+
+    pipeline_settings = {}
+    pipeline_settings.update(IMPORT_PIPELINE)
+    if overrides is not True:
+        pipeline_settings.update(overrides)
+    return pipeline_settings
+
 def get_batch_size():
     """
     Get import batch size, optionally overridden by settings
@@ -41,5 +156,45 @@ def get_batch_size():
     return getattr(settings, 'PHAB_STATS', {}).get('IMPORT_BATCH_SIZE', IMPORT_BATCH_SIZE)
 
 
+def get_pagination():
+    """
+    Get pagination method used to fetch diffs, optionally overridden by settings
+
+    @return 'offset'|'cursor' pagination method
+    """
+    return getattr(settings, 'PHAB_STATS', {}).get('IMPORT_PAGINATION', IMPORT_PAGINATION)
+
+
+def get_batch_files():
+    """
+    Get whether changed files are fetched for a batch of diffs at a time, optionally
+    overridden by settings
+
+    @return bool
+    """
+    return getattr(settings, 'PHAB_STATS', {}).get('IMPORT_BATCH_FILES', IMPORT_BATCH_FILES)
+
+
+def get_import_workers():
+    """
+    Get number of concurrent Conduit fetches used during import, optionally overridden
+    by settings
+
+    @return int number of import worker threads
+    """
+    return getattr(settings, 'PHAB_STATS', {}).get('IMPORT_WORKERS', IMPORT_WORKERS)
+
+
+def get_claim_timeout():
+    """
+    Get seconds after which an unrenewed claim on import work expires, optionally
+    overridden by settings
+
+    @return int claim timeout in seconds
+    """
+    return getattr(settings, 'PHAB_STATS', {}).get('IMPORT_CLAIM_TIMEOUT',
+                                                   IMPORT_CLAIM_TIMEOUT)
+
+
 def get_granularities():
     return GRANULARITIES
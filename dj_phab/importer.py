@@ -2,10 +2,71 @@
 Imports data from Phab API to Django models
 """
 import datetime
-from collections import namedtuple
-from django.db import models, transaction
+import django
+import itertools
+import json
+import logging
+import time
+from collections import Counter, defaultdict, namedtuple, OrderedDict
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
-from dj_phab.models import PhabUser, Project, Repository, PullRequest, UpdatedFile
+from dj_phab.concurrency import map_concurrently, map_stream, measure, prefetch, StageStats
+from dj_phab.conduit import get_story_object_phid, to_timestamp
+from dj_phab.models import ImportJob, ImportWatermark, PhabUser, Project, Repository, \
+                           PullRequest, UpdatedFile
+from dj_phab.util import chunks
+
+
+# Largest number of values to use in a single `IN` clause or bulk statement.  SQLite
+# allows at most 999 parameters per query.
+QUERY_CHUNK_SIZE = 500
+
+# Start of UNIX time
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Most filenames to keep IDs of between polls of a long-running import
+FILE_CACHE_SIZE = 100000
+
+# Types of object, as named in their PHIDs, that feed imports fetch
+PHID_TYPE_USER = 'USER'
+PHID_TYPE_PROJECT = 'PROJ'
+PHID_TYPE_REPOSITORY = 'REPO'
+PHID_TYPE_PULL_REQUEST = 'DREV'
+FEED_PHID_TYPES = (PHID_TYPE_USER, PHID_TYPE_PROJECT, PHID_TYPE_REPOSITORY,
+                   PHID_TYPE_PULL_REQUEST)
+
+# Marks an importer whose existing instance hasn't been searched for yet
+NOT_LOADED = object()
+
+
+def get_phid_type(phid):
+    """
+    @param str phid e.g. 'PHID-DREV-evimsdp6ol7ydgbh4hna'
+    @return str e.g. 'DREV'
+    """
+    return phid.split('-')[1]
+
+
+def get_latest_diff_id(diff_ids):
+    """
+    @param list<str> diff_ids IDs of the versions of a diff, as returned by Conduit
+    @return int|None ID of the latest version
+    """
+    if not diff_ids:
+        return None
+    return max(int(diff_id) for diff_id in diff_ids)
+
+
+def convert_timestamp(raw_value):
+    """
+    Convert a UNIX timestamp straight to an aware datetime in UTC.  Unlike going through
+    local time, this needs no time zone lookup and can't hit ambiguous or non-existent
+    times around DST changes.
+
+    @param str|int raw_value UNIX timestamp
+    @return datetime.datetime
+    """
+    return EPOCH + datetime.timedelta(seconds=int(raw_value))
 
 
 class MissingRequiredDataError(Exception):
@@ -16,13 +77,65 @@ class RelationNotImportedError(Exception):
     pass
 
 
+class IdentityMap(object):
+    """
+    Cache of model instances keyed by PHID, shared by the importers in one import run so
+    that relations to the same users and repositories aren't looked up over and over
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(IdentityMap, self).__init__(*args, **kwargs)
+        self.instances = defaultdict(dict)
+        # PHIDs that have been searched for and not found
+        self.missing = defaultdict(set)
+
+    def add(self, instances):
+        """
+        @param list<PhabModel> instances
+        """
+        for instance in instances:
+            self.instances[type(instance)][instance.phid] = instance
+            self.missing[type(instance)].discard(instance.phid)
+
+    def get(self, model, phid):
+        """
+        Retrieve an instance, querying the DB only if the PHID hasn't been seen before
+
+        @param class model
+        @param str phid
+        @return PhabModel|None
+        """
+        if phid not in self.instances[model] and phid not in self.missing[model]:
+            self.load(model, [phid])
+        return self.instances[model].get(phid)
+
+    def load(self, model, phids):
+        """
+        Cache instances for any of ``phids`` that haven't been seen before, in one query
+
+        @param class model
+        @param iterable<str> phids
+        """
+        phids = set(phids) - set(self.instances[model]) - self.missing[model]
+        for phid_chunk in chunks(list(phids), QUERY_CHUNK_SIZE):
+            self.add(model.objects.filter(phid__in=phid_chunk))
+        self.missing[model].update(phids - set(self.instances[model]))
+
+
 class BaseImporter(object):
 
-    def __init__(self, record, *args, **kwargs):
+    def __init__(self, record, instance=NOT_LOADED, *args, **kwargs):
+        """
+        @param any record Data received from Phab
+        @param Model|None instance Existing model instance for the record, if it has
+            already been looked up; otherwise it's searched for
+        """
         super(BaseImporter, self).__init__(*args, **kwargs)
         self.record = record
-        # search for an instance matching the record and assign to self.instance
-        self.instance = self.find_existing_instance()
+        if instance is NOT_LOADED:
+            # search for an instance matching the record and assign to self.instance
+            instance = self.find_existing_instance()
+        self.instance = instance
 
     @classmethod
     def convert_records(cls, records):
@@ -52,7 +165,7 @@ class Importer(BaseImporter):
     """
     Base class for all importers that convert Phab data to Django models
 
-    Subclasses must override `convert_record` method.
+    Subclasses must define `model` and `field_map` attributes.
     """
 
     Options = namedtuple(
@@ -60,28 +173,307 @@ class Importer(BaseImporter):
         ['phab_name', 'conversion', 'required', 'default']
     )
 
+    def __init__(self, record, instance=NOT_LOADED, identity_map=None, *args, **kwargs):
+        """
+        @param dict record Data received from Phab
+        @param Model|None instance Existing model instance for the record, if it has
+            already been looked up; otherwise it's searched for
+        @param IdentityMap identity_map Used to look up related models
+        """
+        super(Importer, self).__init__(record, instance, *args, **kwargs)
+        self.identity_map = identity_map if identity_map is not None else IdentityMap()
+
+    @classmethod
+    def get_relations(cls):
+        """
+        @return list<(str, class)> Phab field name and related model of each FK and M2M
+            in the field map
+        """
+        relations = []
+        for options in cls.field_map.values():
+            try:
+                model = options.conversion.get('phab_fk') or options.conversion.get('phab_m2m')
+            except AttributeError:
+                continue
+            relations.append((options.phab_name, model))
+        return relations
+
+    @classmethod
+    def convert_records(cls, records, identity_map=None, stats=None, mapped=None):
+        """
+        Convert a list of records received from Phab into persisted Django models, using a
+        fixed number of queries for the whole list rather than several per record:
+        existing instances are loaded in one query, new ones are inserted with
+        `bulk_create`, and changed ones are updated in bulk.  Existing instances whose
+        data hasn't changed aren't written at all.
+
+        Related models are also loaded up front, one query per related model, unless
+        they're already in ``identity_map``.
+
+        If the list contains more than one record with the same PHID, the last one wins.
+
+        @param list<dict> records
+        @param IdentityMap identity_map Related models known so far in this import run
+        @param Counter stats If given, incremented with the number of instances 'created',
+            'updated' and 'skipped' (i.e. unchanged)
+        @param list<dict> mapped Fields already converted by `map_records`, for each record
+        @return list<Model> Model instances
+        """
+        if identity_map is None:
+            identity_map = IdentityMap()
+        if mapped is None:
+            mapped = itertools.repeat(None)
+
+        records_by_phid = OrderedDict()
+        for record, prepared in zip(records, mapped):
+            records_by_phid[cls.get_phid(record)] = (record, prepared)
+
+        for phab_name, model in cls.get_relations():
+            related_phids = set()
+            for record, prepared in records_by_phid.values():
+                value = record.get(phab_name)
+                if isinstance(value, (list, tuple)):
+                    related_phids.update(value)
+                elif value is not None:
+                    related_phids.add(value)
+            identity_map.load(model, related_phids)
+
+        existing = cls.find_existing_instances(records_by_phid.keys())
+        importers = []
+
+        new_importers = []
+        updated_instances = []
+        updated_field_names = set()
+        m2ms_by_importer = []
+
+        for phid, (record, prepared) in records_by_phid.items():
+            importer = cls(record, instance=existing.get(phid), identity_map=identity_map)
+            importers.append(importer)
+            fields, m2ms = importer.map_fields(prepared)
+            m2ms_by_importer.append((importer, m2ms))
+
+            if importer.instance:
+                changed_field_names = importer.update_instance(fields)
+                if changed_field_names:
+                    updated_instances.append(importer.instance)
+                    updated_field_names.update(changed_field_names)
+            else:
+                importer.instance = cls.model(**fields)
+                new_importers.append(importer)
+
+        if new_importers:
+            cls.model.objects.bulk_create([importer.instance for importer in new_importers])
+            if new_importers[0].instance.pk is None:
+                # most DBs don't report primary keys of bulk-created rows
+                created = cls.find_existing_instances(
+                    [importer.instance.phid for importer in new_importers])
+                for importer in new_importers:
+                    importer.instance = created[importer.instance.phid]
+
+        if updated_instances:
+            cls.bulk_update(updated_instances, updated_field_names)
+
+        # And attach M2Ms
+        m2m_changed_pks = cls.sync_m2ms([(importer.instance, m2ms)
+                                         for importer, m2ms in m2ms_by_importer])
+
+        if stats is not None:
+            created_pks = set(importer.instance.pk for importer in new_importers)
+            updated_pks = set(instance.pk for instance in updated_instances)
+            updated_pks.update(m2m_changed_pks - created_pks)
+            stats['created'] += len(created_pks)
+            stats['updated'] += len(updated_pks)
+            stats['skipped'] += len(importers) - len(created_pks) - len(updated_pks)
+
+        return [importer.instance for importer in importers]
+
+    @classmethod
+    def map_records(cls, records):
+        """
+        Convert the fields of many records that depend only on the records themselves,
+        i.e. everything but FKs and M2Ms.  Doesn't touch the DB, so it's safe to run off the
+        main thread, ahead of passing the results to `convert_records`.
+
+        @param list<dict> records
+        @return list<dict> Converted values of each record, keyed by Django field name
+        """
+        converters = cls.get_record_converters()
+        mapped = []
+        for record in records:
+            importer = cls(record, instance=None)
+            mapped.append(dict((django_name, convert(importer))
+                               for django_name, convert in converters))
+        return mapped
+
+    @classmethod
+    def sync_m2ms(cls, instances_and_m2ms):
+        """
+        Bring the M2M relations of many instances up to date, writing directly to the
+        through tables: current rows for all the instances are loaded in one query per
+        field, then only rows that changed are inserted or deleted, in bulk.
+
+        Note that this bypasses `m2m_changed` signals.
+
+        @param list<(Model, dict)> instances_and_m2ms Each instance with a dict of M2M field
+            names to lists of related instances or primary keys
+        @return set Primary keys of instances whose relations changed
+        """
+        changed_pks = set()
+
+        field_names = set(field_name for instance, m2ms in instances_and_m2ms
+                          for field_name in m2ms)
+
+        for field_name in field_names:
+            field = cls.model._meta.get_field(field_name)
+            # Django 1.9+ renamed `rel` to `remote_field`
+            through = (getattr(field, 'remote_field', None) or field.rel).through
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_field_name() + '_id'
+
+            incoming = {}
+            for instance, m2ms in instances_and_m2ms:
+                if field_name in m2ms:
+                    incoming[instance.pk] = set(getattr(value, 'pk', value)
+                                                for value in m2ms[field_name])
+
+            current = defaultdict(dict)
+            for pk_chunk in chunks(list(incoming), QUERY_CHUNK_SIZE):
+                rows = through.objects.filter(**{source + '__in': pk_chunk})\
+                                      .values_list('pk', source, target)
+                for row_pk, source_pk, target_pk in rows:
+                    current[source_pk][target_pk] = row_pk
+
+            stale_rows = []
+            new_rows = []
+            for source_pk, target_pks in incoming.items():
+                for target_pk, row_pk in current[source_pk].items():
+                    if target_pk not in target_pks:
+                        stale_rows.append(row_pk)
+                        changed_pks.add(source_pk)
+                for target_pk in target_pks - set(current[source_pk]):
+                    new_rows.append(through(**{source: source_pk, target: target_pk}))
+                    changed_pks.add(source_pk)
+
+            for row_chunk in chunks(stale_rows, QUERY_CHUNK_SIZE):
+                through.objects.filter(pk__in=row_chunk).delete()
+            if new_rows:
+                through.objects.bulk_create(new_rows)
+
+        return changed_pks
+
+    @classmethod
+    def get_phid(cls, record):
+        try:
+            return record['phid']
+        except KeyError:
+            raise MissingRequiredDataError(u"No PHID found in %s data: %s" %
+                                               (cls.model._meta.verbose_name_raw, record))
+
+    @classmethod
+    def find_existing_instances(cls, phids):
+        """
+        Search for existing model instances for many PHIDs at once
+
+        @param list<str> phids
+        @return dict<str, models.Model> Instances keyed by PHID
+        """
+        instances = {}
+        for phid_chunk in chunks(list(phids), QUERY_CHUNK_SIZE):
+            for instance in cls.model.objects.filter(phid__in=phid_chunk):
+                instances[instance.phid] = instance
+        return instances
+
+    @classmethod
+    def bulk_update(cls, instances, field_names):
+        """
+        Save changes to many existing instances, in one UPDATE per batch of instances
+
+        @param list<models.Model> instances
+        @param set<str> field_names Names of fields that may have changed
+        """
+        # Neither way of updating in bulk calls `pre_save`, so timestamp by hand
+        now = timezone.now()
+        for instance in instances:
+            instance.modified = now
+        field_names = list(field_names) + ['modified']
+
+        manager = cls.model.objects
+        if hasattr(manager, 'bulk_update'):
+            # Django 2.2+
+            manager.bulk_update(instances, field_names, batch_size=QUERY_CHUNK_SIZE)
+            return
+        if not hasattr(models, 'Case'):
+            # Django 1.7 has no conditional expressions to update in bulk with
+            for instance in instances:
+                instance.save(update_fields=field_names)
+            return
+
+        # Otherwise set each field to a CASE over the instances' primary keys, as
+        # `bulk_update` does.  Each instance takes a primary key and a value per field,
+        # plus a primary key to filter on, so batches are sized to keep within SQLite's
+        # limit on query parameters.
+        fields = [cls.model._meta.get_field(name) for name in field_names]
+        batch_size = max(1, QUERY_CHUNK_SIZE // (2 * len(fields) + 1))
+        for batch in chunks(list(instances), batch_size):
+            values = dict(
+                (field.name, models.Case(
+                    *[models.When(pk=instance.pk,
+                                  then=models.Value(getattr(instance, field.attname),
+                                                    output_field=field))
+                      for instance in batch],
+                    output_field=field))
+                for field in fields)
+            manager.filter(pk__in=[instance.pk for instance in batch]).update(**values)
+
     def convert_record(self):
         """
         Convert a dict of data received from Phab into a Django model; save model to DB.
-        If a model already exists for record with given PHID, skips processing.
+        If a model already exists for record with given PHID, updates it.
         """
         # convert the data
         fields, m2ms = self.map_fields()
 
-        # If we already have an instance, update existing record
+        # If we already have an instance, update existing record if anything changed
         if self.instance:
-            for field_name, value in fields.iteritems():
-                if hasattr(self.instance, field_name):
-                    setattr(self.instance, field_name, value)
-            self.instance.save()
+            if self.update_instance(fields):
+                self.instance.save()
         else:
             # Create and save new model instance
             self.instance = self.model.objects.create(**fields)
 
         # And attach M2Ms
-        for field_name, val_list in m2ms.iteritems():
-            if hasattr(self.instance, field_name):
-                setattr(self.instance, field_name, val_list)
+        self.save_m2ms(m2ms)
+
+    def update_instance(self, fields):
+        """
+        Copy mapped field values onto the existing instance
+
+        @param dict fields Mapped fields
+        @return list<str> Names of fields whose values changed
+        """
+        changed_field_names = []
+
+        for field_name, value in fields.iteritems():
+            if not hasattr(self.instance, field_name):
+                continue
+
+            field = self.model._meta.get_field(field_name)
+            if field.attname != field_name:
+                # compare FKs by key, so the current related instance isn't loaded
+                current = getattr(self.instance, field.attname)
+                new = getattr(value, 'pk', value)
+            else:
+                current = getattr(self.instance, field_name)
+                new = value
+
+            if current != new:
+                setattr(self.instance, field_name, value)
+                changed_field_names.append(field_name)
+
+        return changed_field_names
+
+    def save_m2ms(self, m2ms):
+        self.sync_m2ms([(self.instance, m2ms)])
 
     def find_existing_instance(self):
         """
@@ -90,15 +482,10 @@ class Importer(BaseImporter):
         @return models.Model or None
         """
         try:
-            return self.model.objects.get(phid=self.record['phid'])
-        except KeyError:
-            raise MissingRequiredDataError(u"No PHID found in %s data: %s" %
-                                               (self.model._meta.verbose_name_raw, self.record))
+            return self.model.objects.get(phid=self.get_phid(self.record))
         except self.model.DoesNotExist:
             return None
 
-        return None
-
     def get_raw_value(self, field_options):
         """
         Retrieve a raw (un-converted) field value based on Phab API field name,
@@ -107,101 +494,161 @@ class Importer(BaseImporter):
         @param Importer.Options field_options
         @return str raw value
         """
-        try:
+        return self.compile_raw_getter(field_options)(self)
+
+    @classmethod
+    def compile_raw_getter(cls, field_options):
+        """
+        @param Importer.Options field_options
+        @return callable Takes an importer and returns the raw value of the field in its
+            record
+        """
+        phab_name = field_options.phab_name
+        required = field_options.required
+        default = field_options.default
+
+        def get_raw_value(importer):
             # retrieve based on the dict key specified in options
-            value = self.record[field_options.phab_name]
-        except KeyError:
-            value = None
-
-        if value is not None:
-            return value
-        elif field_options.required:
-            # required fields should result in errors if they don't exist in the record
-            raise MissingRequiredDataError(u"Missing field %s in %s data: %s" %
-                                               (field_options.phab_name,
-                                                self.model._meta.verbose_name_raw,
-                                                self.record))
-        else:
-            # non-required fields should use the defined default
-            return field_options.default
+            value = importer.record.get(phab_name)
+
+            if value is not None:
+                return value
+            elif required:
+                # required fields should result in errors if they don't exist in the record
+                raise MissingRequiredDataError(u"Missing field %s in %s data: %s" %
+                                                   (phab_name,
+                                                    cls.model._meta.verbose_name_raw,
+                                                    importer.record))
+            else:
+                # non-required fields should use the defined default
+                return default
+
+        return get_raw_value
 
     def convert_phab_fk(self, raw_value, model):
-        try:
-            return model.objects.get(phid=raw_value)
-        except model.DoesNotExist:
+        instance = self.identity_map.get(model, raw_value)
+        if instance is None:
             raise RelationNotImportedError(u"Related model of class %s with phid %s "
                                            u"not found for %s record with data: %s" %
                                            (model._meta.verbose_name_raw,
                                             raw_value,
                                             self.model._meta.verbose_name_raw,
                                             self.record))
+        return instance
 
     def convert_phab_m2m(self, raw_value, model):
         return [self.convert_phab_fk(val, model) for val in raw_value]
 
-    def map_fields(self):
+    @classmethod
+    def get_converters(cls):
         """
-        This method does the heavy lifting.
-        Fill out a dict of values ready to save directly into a Django model instance,
-        using the importer class's field_map attribute to retrieve appropriate
-        values from the record and convert types as needed
+        Compile the class's field_map into a list of converters the first time it's used,
+        so that mapping each record doesn't have to work out how to convert every field
 
-        @return dict mapped fields
+        @return list<(str, bool, callable)> Django field name, whether the field is an M2M,
+            and a function that takes an importer and returns the converted field value
         """
-        fields = {}
-        m2ms = {}
+        # look in the class's own __dict__ so subclasses don't inherit their parent's
+        if '_converters' not in cls.__dict__:
+            cls._converters = [cls.compile_converter(django_name, options)
+                               for (django_name, options) in cls.field_map.iteritems()]
+        return cls._converters
 
-        for (django_name, options) in self.field_map.iteritems():
-            raw_val = self.get_raw_value(options)
+    @classmethod
+    def get_record_converters(cls):
+        """
+        @return list<(str, callable)> Django field name and converter of each field that
+            isn't an FK or M2M; see `get_converters`
+        """
+        if '_record_converters' not in cls.__dict__:
+            relation_names = set(django_name
+                                 for django_name, options in cls.field_map.iteritems()
+                                 if isinstance(options.conversion, dict)
+                                 or options.conversion == 'm2m')
+            cls._record_converters = [(django_name, convert)
+                                      for django_name, is_m2m, convert in cls.get_converters()
+                                      if django_name not in relation_names]
+        return cls._record_converters
 
-            # Begin type conversion...
+    @classmethod
+    def compile_converter(cls, django_name, options):
+        """
+        @param str django_name
+        @param Importer.Options options
+        @return (str, bool, callable) See `get_converters`
+        """
+        get_raw_value = cls.compile_raw_getter(options)
+        conversion = options.conversion
 
-            # FKs / M2Ms are stored in dicts b/c we also need to know the model they reference
-            try:
-                fk_model = options.conversion.get('phab_fk')
-                m2m_model = options.conversion.get('phab_m2m')
-            except AttributeError:
-                # conversion isn't defined in a dict
-                fk_model = None
-                m2m_model = None
-
-            # convert raw value to correct Python type...
-            # Relationships
-            if m2m_model:
-                val = self.convert_phab_m2m(raw_val, m2m_model)
-            elif fk_model and raw_val is not None:
+        # FKs / M2Ms are stored in dicts b/c we also need to know the model they reference
+        try:
+            fk_model = conversion.get('phab_fk')
+            m2m_model = conversion.get('phab_m2m')
+        except AttributeError:
+            # conversion isn't defined in a dict
+            fk_model = None
+            m2m_model = None
+
+        # Relationships
+        if m2m_model:
+            def convert(importer):
+                return importer.convert_phab_m2m(get_raw_value(importer), m2m_model)
+
+        elif fk_model:
+            def convert(importer):
+                raw_val = get_raw_value(importer)
+                if raw_val is None:
+                    return None
                 try:
-                    val = self.convert_phab_fk(raw_val, fk_model)
+                    return importer.convert_phab_fk(raw_val, fk_model)
                 except RelationNotImportedError:
                     if options.required:
                         raise
-                    else:
-                        val = None
-            elif options.conversion == 'm2m':
-                # We should expect a list of model instances here
-                val = raw_val
-
-            # other types
-            elif options.conversion in (str, 'phid'):
-                # string vals don't need conversion
-                val = raw_val
-
-            elif options.conversion == 'timestamp':
-                # Timestamps need conversion to datetimes
-                val = datetime.datetime.fromtimestamp(int(raw_val))
-                # And saving naive ones raises warnings
-                val = timezone.make_aware(val, timezone.get_current_timezone())
-
-            elif callable(options.conversion):
-                # Any callable other than `str` can be used for a custom conversion
-                val = options.conversion(raw_val)
+                    return None
+
+        # We should expect a list of model instances or IDs for 'm2m', and string vals
+        # don't need conversion
+        elif conversion in ('m2m', str, 'phid'):
+            convert = get_raw_value
+
+        elif conversion == 'timestamp':
+            # Timestamps need conversion to datetimes
+            def convert(importer):
+                return convert_timestamp(get_raw_value(importer))
+
+        elif callable(conversion):
+            # Any callable other than `str` can be used for a custom conversion
+            def convert(importer):
+                return conversion(get_raw_value(importer))
+
+        else:
+            # if all else fails
+            convert = get_raw_value
+
+        return django_name, bool(m2m_model or conversion == 'm2m'), convert
+
+    def map_fields(self, prepared=None):
+        """
+        This method does the heavy lifting.
+        Fill out a dict of values ready to save directly into a Django model instance,
+        using the importer class's compiled field_map to retrieve appropriate
+        values from the record and convert types as needed
+
+        @param dict prepared Values already converted by `map_records`
+        @return dict mapped fields
+        """
+        fields = {}
+        m2ms = {}
+
+        for django_name, is_m2m, convert in self.get_converters():
+            if prepared is not None and django_name in prepared:
+                val = prepared[django_name]
             else:
-                # if all else fails
-                val = raw_val
+                val = convert(self)
 
             # add it to the list of values we'll return
             if val is not None:
-                if m2m_model or options.conversion == 'm2m':
+                if is_m2m:
                     m2ms[django_name] = val
                 else:
                     fields[django_name] = val
@@ -261,6 +708,7 @@ class PullRequestImporter(Importer):
         'status':       Importer.Options('status', int, True, None),
         'uri':          Importer.Options('uri', str, True, ''),
         'diff_count':   Importer.Options('diffs', len, True, ''),
+        'latest_diff_id': Importer.Options('diffs', get_latest_diff_id, False, None),
         'commit_count': Importer.Options('commits', len, True, None),
         'date_opened':  Importer.Options('dateCreated', 'timestamp', True, None),
         'date_updated': Importer.Options('dateModified', 'timestamp', True, None),
@@ -278,6 +726,83 @@ class UpdatedFileImporter(BaseImporter):
         if not self.instance:
             self.instance = UpdatedFile.objects.create(filename=self.record)
 
+    @classmethod
+    def convert_records(cls, records):
+        """
+        Convert a list of filenames into persisted models, in bulk
+
+        @param list<str> records Filenames
+        @return list<UpdatedFile> Model instances
+        """
+        file_ids = cls.intern(records)
+        instances = UpdatedFile.objects.in_bulk(list(set(file_ids.values())))
+        return [instances[file_ids[filename]] for filename in records]
+
+    @classmethod
+    def intern(cls, filenames, known_ids=None):
+        """
+        Find or create `UpdatedFile`s for many filenames at once: existing files are looked
+        up in one query (per chunk) and missing ones are inserted in one statement.  Rows
+        inserted concurrently by another import are tolerated.
+
+        @param iterable<str> filenames
+        @param dict<str, int> known_ids IDs of filenames already interned, e.g. in earlier
+            batches of the same import run.  Updated in place with new IDs.
+        @return dict<str, int> IDs keyed by filename
+        """
+        if known_ids is None:
+            known_ids = {}
+        filenames = set(filenames)
+
+        cls.load_ids(filenames - set(known_ids), known_ids)
+
+        missing = filenames - set(known_ids)
+        if missing:
+            new_files = [UpdatedFile(filename=filename) for filename in missing]
+            if django.VERSION >= (2, 2):
+                UpdatedFile.objects.bulk_create(new_files, ignore_conflicts=True)
+            else:
+                try:
+                    with transaction.atomic():
+                        UpdatedFile.objects.bulk_create(new_files)
+                except IntegrityError:
+                    # another import inserted some of the same files; fall back to
+                    # inserting one by one
+                    for filename in missing:
+                        UpdatedFile.objects.get_or_create(filename=filename)
+            cls.load_ids(missing, known_ids)
+
+        return dict((filename, known_ids[filename]) for filename in filenames)
+
+    @classmethod
+    def load_ids(cls, filenames, known_ids):
+        """
+        @param iterable<str> filenames
+        @param dict<str, int> known_ids Updated in place with IDs of any existing files
+        """
+        for filename_chunk in chunks(list(filenames), QUERY_CHUNK_SIZE):
+            known_ids.update(UpdatedFile.objects.filter(filename__in=filename_chunk)
+                                                .values_list('filename', 'id'))
+
+
+class PendingPage(object):
+    """
+    A page of diffs on its way through an import, with the results of each step so far
+    """
+
+    def __init__(self, diffs, *args, **kwargs):
+        """
+        @param Page<dict> diffs Diffs as returned by Conduit
+        """
+        super(PendingPage, self).__init__(*args, **kwargs)
+        self.diffs = diffs
+        # diffs with new versions, whose changed files need fetching
+        self.changed_diffs = None
+        # changed files of each of the changed diffs
+        self.file_lists = None
+        # fields of each diff converted ahead of saving; see `Importer.map_records`
+        self.mapped = None
+
 
 class ImportRunner(object):
     """
@@ -285,29 +810,446 @@ class ImportRunner(object):
     save to DB
     """
 
-    def __init__(self, api, *args, **kwargs):
+    def __init__(self, api, workers=1, batch_files=True, pipeline=None, *args, **kwargs):
+        """
+        @param ConduitAPI api
+        @param int workers Number of threads used to fetch data concurrently
+        @param bool batch_files Whether to fetch changed files for a whole batch of diffs in
+            one request, rather than one request per diff
+        @param dict pipeline If given, diffs are imported in pipelined stages; see
+            `pipeline_pages`.  Keys are 'fetch_workers' and 'map_workers' (threads per
+            stage) and 'queue_size' (pages held between stages).
+        """
         super(ImportRunner, self).__init__(*args, **kwargs)
         self.api = api
+        self.workers = workers
+        self.batch_files = batch_files
+        self.pipeline = pipeline
+        self.reset_caches()
+        self.stats = self.new_stats()
+        self.stage_stats = self.new_stage_stats()
 
-    def run(self, last_import_time):
+    def reset_caches(self):
+        """
+        Forget the users, repositories and files cached by earlier runs, e.g. because the
+        transaction that saved some of them was rolled back
+        """
+        # Cache users and repos as they're imported so diffs can refer to them for free
+        self.identity_map = IdentityMap()
+        # Likewise files, which recur across many diffs
+        self.file_ids = {}
+        # PHIDs of relations fetched on demand that Conduit didn't return, keyed by model
+        self.unfetchable = defaultdict(set)
+
+    def run(self, last_import_time, chunk_size=None, checkpoint=None, watermarks=None):
         """
         Execute the import
+
+        By default everything is saved in the caller's transaction.  In chunked mode the
+        import commits as it goes instead, so it must not be run inside a transaction:
+        reference data is committed first, then diffs in chunks of about ``chunk_size``,
+        each together with ``checkpoint``.  If the import fails, running it again with the
+        saved checkpoint carries on from the last chunk committed.
+
+        @param datetime.datetime last_import_time Only diffs modified since then are imported
+        @param int chunk_size If given, commit after about this many diffs
+        @param ImportCheckpoint checkpoint Required in chunked mode; diffs are imported from
+            its position, which is updated as they're committed
+        @param dict<str, datetime.datetime> watermarks See `import_reference_data`
+        """
+        self.reset_caches()
+        self.stats = self.new_stats()
+        self.stage_stats = self.new_stage_stats()
+
+        self.import_reference_data(watermarks)
+        self.import_diffs(last_import_time, chunk_size, checkpoint)
+
+    def poll(self, last_import_time, refresh_reference_data=False, watermarks=None):
+        """
+        Import diffs modified since ``last_import_time``, for a long-running import that
+        polls for changes.  Unlike `run`, users, repositories and files cached by earlier
+        polls are kept, and users, projects and repositories modified since their watermarks
+        are only fetched if ``refresh_reference_data``.  Any created in the meantime are
+        fetched as diffs refer to them.
+
+        @param datetime.datetime last_import_time
+        @param bool refresh_reference_data
+        @param dict<str, datetime.datetime> watermarks See `import_reference_data`
+        """
+        if len(self.file_ids) > FILE_CACHE_SIZE:
+            self.file_ids = {}
+        # Conduit may return these now
+        self.unfetchable = defaultdict(set)
+        self.stats = self.new_stats()
+        self.stage_stats = self.new_stage_stats()
+
+        if refresh_reference_data:
+            self.import_reference_data(watermarks)
+        self.import_diffs(last_import_time)
+
+    def import_diffs(self, last_import_time, chunk_size=None, checkpoint=None):
+        """
+        Import diffs modified since ``last_import_time``; see `run`
+
+        @param datetime.datetime last_import_time
+        @param int chunk_size
+        @param ImportCheckpoint checkpoint
+        """
+        # Fetch diffs modified since last import, one batch at a time so memory use is
+        # bounded by the batch size.  With workers available, the next batch is fetched
+        # while the current one is being saved.
+        position = (checkpoint.position or None) if checkpoint else None
+        pages = measure(
+            self.api.iter_pull_requests(modified_since=last_import_time, position=position),
+            self.stage_stats['fetch'])
+        if self.pipeline:
+            pages = self.pipeline_pages(pages)
+        else:
+            if self.workers > 1:
+                pages = prefetch(pages)
+            pages = (PendingPage(diffs) for diffs in pages)
+
+        if not chunk_size:
+            for page in pages:
+                self.save_page(page)
+            return
+
+        pages = iter(pages)
+        exhausted = False
+        while not exhausted:
+            with transaction.atomic():
+                imported = 0
+                while imported < chunk_size:
+                    page = next(pages, None)
+                    if page is None:
+                        exhausted = True
+                        break
+                    self.save_page(page)
+                    imported += len(page.diffs)
+                    checkpoint.position = page.diffs.position or ''
+                checkpoint.save()
+                logging.info('committed %s diffs; resume position %r' %
+                             (imported, checkpoint.position))
+
+    def import_reference_data(self, watermarks=None):
+        """
+        Import users, projects and repositories, in one transaction
+
+        @param dict<str, datetime.datetime> watermarks If given, only users, projects and
+            repositories modified since their `ImportWatermark` are imported; types of data
+            without a watermark are imported in full
+        """
+        watermarks = watermarks or {}
+        with transaction.atomic():
+            # Fetch users
+            self.identity_map.add(UserImporter.convert_records(
+                self.api.fetch_users(modified_since=watermarks.get(ImportWatermark.USERS)),
+                stats=self.stats['users']))
+
+            # Fetch projects
+            ProjectImporter.convert_records(
+                self.api.fetch_projects(
+                    modified_since=watermarks.get(ImportWatermark.PROJECTS)),
+                stats=self.stats['projects'])
+
+            # Fetch repos
+            self.identity_map.add(RepositoryImporter.convert_records(
+                self.api.fetch_repositories(
+                    modified_since=watermarks.get(ImportWatermark.REPOSITORIES)),
+                stats=self.stats['repositories']))
+
+    def import_shard(self, shard):
+        """
+        Import the diffs in a backfill shard.  Each page is committed on its own and the
+        claim on the shard is renewed after it, so a long shard isn't mistaken for a
+        crashed worker's.  Re-importing a shard after a crash is safe: diffs already saved
+        are skipped.
+
+        @param ImportShard shard
+        """
+        pages = measure(self.api.iter_pull_requests_by_id(shard.start_id, shard.end_id),
+                        self.stage_stats['fetch'])
+        for diffs in pages:
+            with transaction.atomic():
+                self.save_page(PendingPage(diffs))
+            shard.renew()
+
+    def import_feed(self, watermark):
+        """
+        Import the users, projects, repositories and diffs that feed stories newer than
+        ``watermark.cursor`` are about, so the work done is proportional to the activity
+        since then rather than to the number of diffs.  Stories are read a page at a time;
+        the objects each page is about are fetched by PHID, in a request per type, and
+        saved in one transaction together with the watermark's cursor, so a failed import
+        carries on from the last page saved.
+
+        Changes that don't publish feed stories, e.g. edits to users, are only picked up
+        by regular imports.
+
+        @param ImportWatermark watermark Position in the feed, with a chronological key as
+            its cursor
+        """
+        self.reset_caches()
+        self.stats = self.new_stats()
+        self.stage_stats = self.new_stage_stats()
+
+        for stories in self.api.iter_feed(watermark.cursor):
+            phids = defaultdict(set)
+            for story in stories:
+                phid = get_story_object_phid(story)
+                if phid:
+                    phids[get_phid_type(phid)].add(phid)
+                else:
+                    logging.warning('feed story %s is not about an object' %
+                                    story.get('chronologicalKey'))
+            ignored = set(phids) - set(FEED_PHID_TYPES)
+            if ignored:
+                logging.info('ignoring feed stories about %s objects' %
+                             ', '.join(sorted(ignored)))
+
+            with transaction.atomic():
+                if phids[PHID_TYPE_USER]:
+                    self.identity_map.add(UserImporter.convert_records(
+                        self.api.fetch_users(phids=sorted(phids[PHID_TYPE_USER])),
+                        stats=self.stats['users']))
+                if phids[PHID_TYPE_PROJECT]:
+                    ProjectImporter.convert_records(
+                        self.api.fetch_projects(phids=sorted(phids[PHID_TYPE_PROJECT])),
+                        stats=self.stats['projects'])
+                if phids[PHID_TYPE_REPOSITORY]:
+                    self.identity_map.add(RepositoryImporter.convert_records(
+                        self.api.fetch_repositories(
+                            phids=sorted(phids[PHID_TYPE_REPOSITORY])),
+                        stats=self.stats['repositories']))
+                if phids[PHID_TYPE_PULL_REQUEST]:
+                    diffs = self.api.fetch_pull_requests_by_phid(
+                        sorted(phids[PHID_TYPE_PULL_REQUEST]))
+                    if diffs:
+                        self.save_page(PendingPage(diffs))
+
+                watermark.cursor = stories.position
+                watermark.save()
+
+    def enqueue(self, last_import_time, watermarks=None, started=None):
+        """
+        Import reference data, then queue the import of diffs modified since
+        ``last_import_time`` as jobs for workers to claim, one per page of diffs.  Every
+        job is queued up front, so workers on any number of nodes can start on them at
+        once: only the IDs of the diffs are listed here, and each job fetches its own
+        diffs and their files.
+
+        @param datetime.datetime last_import_time Only diffs modified since then are imported
+        @param dict<str, datetime.datetime> watermarks See `import_reference_data`
+        @param datetime.datetime started When the import started; defaults to now
+        @return list<ImportJob> The jobs queued
+        """
+        started = started or timezone.now()
+        self.import_reference_data(watermarks)
+        jobs = [ImportJob(kind=ImportJob.KIND.diffs,
+                          payload=json.dumps({'ids': ids, 'started': to_timestamp(started)}))
+                for ids in self.api.iter_pull_request_ids(last_import_time)]
+        ImportJob.objects.bulk_create(jobs)
+        return jobs
+
+    def run_job(self, job):
+        """
+        Do the work of a claimed job
+
+        @param ImportJob job
         """
-        # Fetch all users
-        UserImporter.convert_records(self.api.fetch_users())
+        if job.kind != ImportJob.KIND.diffs:
+            raise ValueError(u"Unknown kind of import job: %s" % job.kind)
 
-        # Fetch all projects
-        ProjectImporter.convert_records(self.api.fetch_projects())
+        diffs = self.api.fetch_pull_requests_by_id(job.get_payload()['ids'])
+        if diffs:
+            with transaction.atomic():
+                self.save_page(PendingPage(diffs))
 
-        # Fetch all repos
-        RepositoryImporter.convert_records(self.api.fetch_repositories())
+    def pipeline_pages(self, pages):
+        """
+        Run pages of diffs through the stages of the import that don't write to the DB,
+        each on its own threads, so that fetching, converting and saving all overlap:
+
+        - fetch: pages are read from Conduit ahead of the other stages
+        - files: changed files are fetched for diffs with new versions
+        - map: fields that don't refer to other models are converted
 
-        # Fetch diffs modified since last import
-        diffs = self.api.fetch_pull_requests(modified_since=last_import_time)
+        The remaining stage, write, is the caller's, so that all writes stay on its
+        thread and inside its transaction.  Stages are joined by bounded queues, so a
+        slow stage holds back the ones before it and memory use stays flat.
 
-        for diff in diffs:
-            filenames = self.api.fetch_files(int(diff['id']))
-            files = UpdatedFileImporter.convert_records(filenames)
-            diff['files'] = files
+        @param iterable<Page<dict>> pages
+        @return generator<PendingPage> Pages ready to be passed to `save_page`
+        """
+        queue_size = self.pipeline['queue_size']
+        pages = prefetch(pages, queue_size)
+        # Checking which diffs have new versions needs the DB, so happens on this thread
+        pages = (self.select_changed_diffs(PendingPage(diffs)) for diffs in pages)
+        pages = map_stream(self.fetch_page_files, pages, self.pipeline['fetch_workers'],
+                           queue_size)
+        return map_stream(self.map_page, pages, self.pipeline['map_workers'], queue_size)
+
+    def import_pull_requests(self, diffs):
+        """
+        Fetch changed files for a batch of diffs and save both to the DB
+
+        @param list<dict> diffs Diffs as returned by Conduit
+        @return list<PullRequest>
+        """
+        return self.save_page(PendingPage(diffs))
+
+    def select_changed_diffs(self, page):
+        """
+        Find the diffs in a page that have had new versions pushed since they were last
+        imported: only those have their files fetched, the others keep the files they
+        already have
 
-        PullRequestImporter.convert_records(diffs)
+        @param PendingPage page
+        @return PendingPage
+        """
+        imported_diff_ids = dict(
+            PullRequest.objects.filter(phid__in=[diff['phid'] for diff in page.diffs])
+                               .values_list('phid', 'latest_diff_id'))
+        page.changed_diffs = []
+        for diff in page.diffs:
+            latest_diff_id = get_latest_diff_id(diff.get('diffs'))
+            if latest_diff_id is None or imported_diff_ids.get(diff['phid']) != latest_diff_id:
+                page.changed_diffs.append(diff)
+        return page
+
+    def fetch_page_files(self, page):
+        """
+        Fetch changed files for the changed diffs in a page.  Doesn't touch the DB.
+
+        @param PendingPage page
+        @return PendingPage
+        """
+        started = time.time()
+        if self.batch_files:
+            files_by_id = self.api.fetch_files_for_pull_requests(page.changed_diffs)
+            page.file_lists = [files_by_id.get(int(diff['id']), [])
+                               for diff in page.changed_diffs]
+        else:
+            # Commit paths are fetched concurrently, but files are saved on the caller's
+            # thread so that all DB writes stay inside its transaction
+            page.file_lists = map_concurrently(self.fetch_files, page.changed_diffs,
+                                               self.workers)
+        self.stage_stats['files'].record(len(page.changed_diffs), time.time() - started)
+        return page
+
+    def map_page(self, page):
+        """
+        Convert the fields of a page's diffs that don't refer to other models.  Doesn't
+        touch the DB.
+
+        @param PendingPage page
+        @return PendingPage
+        """
+        started = time.time()
+        page.mapped = PullRequestImporter.map_records(page.diffs)
+        self.stage_stats['map'].record(len(page.diffs), time.time() - started)
+        return page
+
+    def save_page(self, page):
+        """
+        Save a page of diffs and their files to the DB, first doing any steps that
+        haven't been done yet
+
+        @param PendingPage page
+        @return list<PullRequest>
+        """
+        if page.changed_diffs is None:
+            self.select_changed_diffs(page)
+        if page.file_lists is None:
+            self.fetch_page_files(page)
+
+        started = time.time()
+        # Save all the batch's files at once
+        file_ids = UpdatedFileImporter.intern(
+            [filename for filenames in page.file_lists for filename in filenames],
+            self.file_ids)
+        for diff, filenames in zip(page.changed_diffs, page.file_lists):
+            diff['files'] = [file_ids[filename] for filename in filenames]
+
+        self.import_missing_relations(page.diffs)
+        pull_requests = PullRequestImporter.convert_records(
+            page.diffs, self.identity_map, self.stats['pull requests'], page.mapped)
+        self.stage_stats['write'].record(len(page.diffs), time.time() - started)
+        return pull_requests
+
+    def import_missing_relations(self, diffs):
+        """
+        Import users and repositories that diffs refer to but that haven't been imported,
+        e.g. because they were created after the run fetched all of them.  They're
+        fetched by PHID, in one request per model for the whole batch.  Rows inserted
+        concurrently by another import, e.g. another backfill process, are tolerated.
+
+        @param list<dict> diffs Diffs as returned by Conduit
+        """
+        fetchers = {
+            PhabUser: (self.api.fetch_users, UserImporter, 'users'),
+            Repository: (self.api.fetch_repositories, RepositoryImporter, 'repositories'),
+        }
+
+        for phab_name, model in PullRequestImporter.get_relations():
+            if model not in fetchers:
+                continue
+
+            phids = set()
+            for diff in diffs:
+                value = diff.get(phab_name)
+                if isinstance(value, (list, tuple)):
+                    phids.update(value)
+                elif value is not None:
+                    phids.add(value)
+
+            self.identity_map.load(model, phids)
+            missing = phids - set(self.identity_map.instances[model]) - self.unfetchable[model]
+            if not missing:
+                continue
+
+            fetch, importer, stats_name = fetchers[model]
+            logging.info('fetching %s missing %s' % (len(missing), stats_name))
+            records = fetch(phids=sorted(missing))
+            stats = Counter()
+            try:
+                with transaction.atomic():
+                    instances = importer.convert_records(records, stats=stats)
+            except IntegrityError:
+                # another import inserted some of them first; those are updated instead
+                stats = Counter()
+                instances = importer.convert_records(records, stats=stats)
+            self.stats[stats_name].update(stats)
+            self.identity_map.add(instances)
+            # don't ask again for anything Conduit didn't return
+            self.unfetchable[model].update(missing - set(self.identity_map.instances[model]))
+
+    def fetch_files(self, diff):
+        return self.api.fetch_files(int(diff['id']))
+
+    @staticmethod
+    def new_stats():
+        """
+        @return OrderedDict<str, Counter> Counts of created, updated and skipped records
+            for each type of data imported
+        """
+        return OrderedDict((name, Counter())
+                           for name in ('users', 'projects', 'repositories', 'pull requests'))
+
+    @staticmethod
+    def new_stage_stats():
+        """
+        @return OrderedDict<str, StageStats> Throughput of each stage of importing diffs
+        """
+        return OrderedDict((name, StageStats(name))
+                           for name in ('fetch', 'files', 'map', 'write'))
+
+    def get_summary(self):
+        """
+        @return list<str> One line per type of data imported, then one per stage of
+            importing diffs that ran
+        """
+        return [u"%s: %s created, %s updated, %s unchanged" %
+                (name.capitalize(), counts['created'], counts['updated'], counts['skipped'])
+                for name, counts in self.stats.items()] + \
+               [stats.get_summary() for stats in self.stage_stats.values() if stats.batches]
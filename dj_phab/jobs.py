@@ -0,0 +1,107 @@
+"""
+Workers for imports queued as `ImportJob`s, which can run on any number of nodes
+"""
+import logging
+import time
+import traceback
+from django.db import transaction
+from django.utils import timezone
+from dj_phab.importer import convert_timestamp
+from dj_phab.models import ImportJob, ImportWatermark
+
+
+# Attempts at a job before it's marked as failed
+MAX_ATTEMPTS = 3
+
+# Seconds before a failed job is first retried; doubles with every further retry
+RETRY_DELAY = 30
+
+# Seconds a worker waits before looking for jobs again while other workers' jobs are in
+# progress or failed jobs are waiting to be retried
+POLL_INTERVAL = 5
+
+
+def is_import_queued():
+    """
+    @return bool Whether a queued import still has jobs to do
+    """
+    return ImportJob.objects.filter(
+        status__in=[ImportJob.STATUS.pending, ImportJob.STATUS.claimed]).exists()
+
+
+def queue_import(runner, watermarks):
+    """
+    Queue an import of data modified since its watermark, clearing out the jobs of
+    earlier imports.  Nothing is queued if an earlier import is still in progress.  The
+    jobs are queued in one transaction, so workers never see part of an import.
+
+    @param ImportRunner runner
+    @param dict<str, datetime.datetime> watermarks See `ImportWatermark.get_watermarks`
+    @return list<ImportJob>|None The jobs, or None if an import is already queued
+    """
+    if is_import_queued():
+        return None
+
+    started = timezone.now()
+    with transaction.atomic():
+        ImportJob.objects.all().delete()
+        jobs = runner.enqueue(watermarks.get(ImportWatermark.PULL_REQUESTS), watermarks,
+                              started)
+        if not jobs:
+            # no diffs have changed, so there's nothing left to wait for
+            ImportWatermark.update_watermarks(started)
+    return jobs
+
+
+def run_worker(runner, name, claim_timeout, retry_delay=RETRY_DELAY, sleep=time.sleep):
+    """
+    Claim and do jobs until the import is done.  While no job can be claimed but others
+    are still in progress, or waiting to be retried, the worker waits for them, so that
+    it can take over the jobs of crashed workers and retry failed ones.  Failed jobs are
+    retried up to `MAX_ATTEMPTS` times.  Once every job of an import is done, the import
+    watermarks are moved on to when it was queued.
+
+    @param ImportRunner runner
+    @param str name Name of the worker, recorded on the jobs it claims
+    @param int claim_timeout Seconds after which an unrenewed claim expires
+    @param float retry_delay Seconds before a failed job is first retried
+    @param callable sleep Function used to wait for jobs
+    @return int Number of jobs done
+    """
+    done = 0
+    while True:
+        job = ImportJob.claim(name, claim_timeout)
+        if job is None:
+            if not is_import_queued():
+                return done
+            sleep(POLL_INTERVAL)
+            continue
+
+        logging.info('%s running job %s' % (name, job))
+        try:
+            runner.run_job(job)
+        except Exception:
+            logging.exception('%s failed job %s' % (name, job))
+            job.fail(traceback.format_exc(), MAX_ATTEMPTS, retry_delay)
+            # The runner's caches may hold rows the rollback just removed
+            runner.reset_caches()
+            continue
+
+        job.finish()
+        done += 1
+        complete_import(job)
+
+
+def complete_import(job):
+    """
+    Move the import watermarks on if every job of the import ``job`` belongs to is done
+
+    @param ImportJob job
+    """
+    if ImportJob.objects.exclude(status=ImportJob.STATUS.done).exists():
+        return
+
+    started = convert_timestamp(job.get_payload()['started'])
+    last_import_time = ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS)
+    if last_import_time is None or last_import_time < started:
+        ImportWatermark.update_watermarks(started)
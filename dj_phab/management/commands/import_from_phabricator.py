@@ -1,12 +1,28 @@
+import multiprocessing
+import os
+import socket
+from optparse import make_option
+
 from django.conf import settings
 from django.core.management.base import NoArgsCommand, CommandError
 from django.db import transaction
+from django.db.models import Min
 from django.utils import timezone
 
+from dj_phab.backfill import get_unfinished_shards, MAX_ATTEMPTS, plan_shards, \
+                             run_backfill
+from dj_phab.batching import AdaptiveBatchSize
+from dj_phab.daemon import ImportDaemon
 from dj_phab.conduit import ConduitAPI
-from dj_phab.defaults import get_batch_size
+from dj_phab.defaults import get_adaptive_batch_settings, get_batch_files, get_batch_size, \
+                             get_claim_timeout, get_import_workers, get_pagination, \
+                             get_pipeline_settings, get_rate_limits, get_retry_settings
 from dj_phab.importer import ImportRunner
-from dj_phab.models import LastImportTracker
+from dj_phab.jobs import queue_import, run_worker
+from dj_phab.models import ImportCheckpoint, ImportShard, ImportWatermark
+from dj_phab.ratelimit import RateLimiter
+from dj_phab.retry import RetryPolicy
+from dj_phab.transport import PooledHTTPTransport
 
 from phabricator import Phabricator
 
@@ -15,21 +31,240 @@ class Command(NoArgsCommand):
            u"data updated since last import; or all data if this is the initial import"
     can_import_settings = True
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help=u"Commit after about this many diffs, so that a failed import can "
+                         u"be resumed by running it again"),
+        make_option('--backfill', action='store_true', dest='backfill', default=False,
+                    help=u"Import all diffs using several processes, each importing shards "
+                         u"of diff IDs"),
+        make_option('--processes', type='int', dest='processes',
+                    default=multiprocessing.cpu_count(),
+                    help=u"Number of backfill processes; defaults to one per CPU"),
+        make_option('--shard-size', type='int', dest='shard_size', default=1000,
+                    help=u"Number of diff IDs per backfill shard"),
+        make_option('--enqueue', action='store_true', dest='enqueue', default=False,
+                    help=u"Import users, projects and repositories, then queue the import of "
+                         u"diffs as jobs for workers (see --worker)"),
+        make_option('--worker', action='store_true', dest='worker', default=False,
+                    help=u"Do queued import jobs until there are none left"),
+        make_option('--feed', action='store_true', dest='feed', default=False,
+                    help=u"Import only what the Phabricator feed says changed since the last "
+                         u"feed import"),
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+                    help=u"Keep running, importing changes every --interval seconds until "
+                         u"stopped with SIGTERM"),
+        make_option('--interval', type='float', dest='interval', default=60,
+                    help=u"Seconds between daemon polls"),
+        make_option('--refresh-interval', type='float', dest='refresh_interval',
+                    default=3600,
+                    help=u"Seconds between daemon fetches of modified users, projects and "
+                         u"repositories"),
+    )
+
+    def get_runner(self):
+        """
+        Set up our API connection and an import runner using it
+
+        @return ImportRunner
+        """
+        adaptive_batch_settings = get_adaptive_batch_settings()
+        if adaptive_batch_settings:
+            batch_sizer = AdaptiveBatchSize(get_batch_size(), **adaptive_batch_settings)
+        else:
+            batch_sizer = None
+
+        # One connection per worker, plus one for the thread reading pages of diffs ahead,
+        # plus one per thread fetching files in a pipelined import
+        phabricator = Phabricator()
+        workers = get_import_workers()
+        pipeline = get_pipeline_settings()
+        pool_size = workers + 1
+        if pipeline:
+            pool_size += pipeline['fetch_workers']
+        transport = PooledHTTPTransport(phabricator, pool_size=pool_size)
+
+        conduit = ConduitAPI(phabricator, get_batch_size(),
+                             pagination=get_pagination(),
+                             workers=workers,
+                             retry_policy=RetryPolicy(**get_retry_settings()),
+                             rate_limiter=RateLimiter(get_rate_limits()),
+                             batch_sizer=batch_sizer,
+                             transport=transport)
+
+        return ImportRunner(conduit, workers, get_batch_files(), pipeline)
+
     def handle_noargs(self, **options):
-        # Fetch last import time
-        last_import_time = LastImportTracker.get_last_import_time()
+        if options.get('backfill'):
+            return self.backfill(options['processes'], options['shard_size'])
+        if options.get('enqueue'):
+            return self.enqueue()
+        if options.get('worker'):
+            return self.work()
+        if options.get('daemon'):
+            return self.daemon(options['interval'], options['refresh_interval'])
+        if options.get('feed'):
+            return self.import_feed()
 
-        # Set up our API connection
-        conduit = ConduitAPI(Phabricator(), get_batch_size())
+        # Fetch how far earlier imports got
+        started = timezone.now()
+        watermarks = ImportWatermark.get_watermarks()
+        last_import_time = watermarks.get(ImportWatermark.PULL_REQUESTS)
 
-        # Start a transaction; will commit on completion of block; rollback upon uncaught
-        # exception
-        with transaction.atomic():
-            # Import data
-            import_runner = ImportRunner(conduit)
-            import_runner.run(last_import_time)
+        import_runner = self.get_runner()
+        chunk_size = options.get('chunk_size')
+        try:
+            if chunk_size:
+                # Carry on from where an unfinished chunked import stopped, if there is one
+                checkpoint = ImportCheckpoint.get_checkpoint(
+                    ImportCheckpoint.PULL_REQUESTS, last_import_time, started)
+                if checkpoint.pk:
+                    self.stdout.write(u"Resuming import started at %s" % checkpoint.started)
+                import_runner.run(checkpoint.watermark, chunk_size, checkpoint, watermarks)
 
-            # Update last import time
-            LastImportTracker.update_last_import_time(timezone.now())
+                # Only move the watermarks on once every chunk is in, and back to when the
+                # import started so that nothing modified during it is missed
+                with transaction.atomic():
+                    ImportWatermark.update_watermarks(checkpoint.started)
+                    checkpoint.delete()
+            else:
+                # Start a transaction; will commit on completion of block; rollback upon
+                # uncaught exception
+                with transaction.atomic():
+                    # Import data
+                    import_runner.run(last_import_time, watermarks=watermarks)
 
+                    # Update watermarks to when the import started, so that anything
+                    # modified during it is imported next time; any unfinished chunked
+                    # import is superseded
+                    ImportWatermark.update_watermarks(started)
+                    ImportCheckpoint.objects.filter(
+                        entity=ImportCheckpoint.PULL_REQUESTS).delete()
+        finally:
+            import_runner.api.transport.close()
+
+        for line in import_runner.get_summary():
+            self.stdout.write(line)
+        self.stdout.write(u"Data successfully imported")
+
+    def import_feed(self):
+        """
+        Import what feed stories since the last feed import are about.  The first feed
+        import instead starts the feed from its newest story and does a regular import.
+        """
+        watermark = ImportWatermark.objects.get_or_create(entity=ImportWatermark.FEED)[0]
+        import_runner = self.get_runner()
+        try:
+            if watermark.cursor:
+                import_runner.import_feed(watermark)
+            else:
+                started = timezone.now()
+                watermarks = ImportWatermark.get_watermarks()
+                with transaction.atomic():
+                    # Stories published from here on are read by the next feed import
+                    watermark.cursor = import_runner.api.fetch_latest_feed_key() or '0'
+                    import_runner.run(watermarks.get(ImportWatermark.PULL_REQUESTS),
+                                      watermarks=watermarks)
+                    ImportWatermark.update_watermarks(started)
+                    watermark.save()
+        finally:
+            import_runner.api.transport.close()
+
+        for line in import_runner.get_summary():
+            self.stdout.write(line)
         self.stdout.write(u"Data successfully imported")
+
+    def backfill(self, processes, shard_size):
+        """
+        Import all data, splitting diffs into shards of IDs that are imported by several
+        worker processes.  If a backfill stops, running it again carries on with the shards
+        that weren't imported.  Once every shard is imported or has failed, the backfill
+        isn't run again.
+
+        @param int processes Number of worker processes
+        @param int shard_size Number of diff IDs per shard
+        """
+        if ImportShard.objects.exists() and not get_unfinished_shards().exists():
+            self.check_failed_shards()
+            self.stdout.write(u"The backfill has already been done")
+            return
+
+        started = timezone.now()
+        import_runner = self.get_runner()
+        try:
+            import_runner.import_reference_data()
+            shard_count = plan_shards(import_runner.api, shard_size)
+        finally:
+            # don't let the worker processes inherit open connections
+            import_runner.api.transport.close()
+
+        # The next regular import picks up anything modified since the backfill started,
+        # including earlier attempts at it
+        planned = ImportShard.objects.aggregate(planned=Min('created'))['planned']
+        if planned is not None:
+            started = min(started, planned)
+
+        self.stdout.write(u"Importing %s shards of diffs in %s processes" %
+                          (shard_count, processes))
+        if not run_backfill(self.get_runner, processes, get_claim_timeout()):
+            self.check_failed_shards()
+            raise CommandError(u"Some shards weren't imported.  Run the backfill again to "
+                               u"carry on with them.")
+
+        ImportWatermark.update_watermarks(started)
+        self.stdout.write(u"Data successfully imported")
+
+    def check_failed_shards(self):
+        """
+        Raise a `CommandError` if any backfill shards failed
+        """
+        failed = ImportShard.objects.filter(status=ImportShard.STATUS.failed)
+        if failed.exists():
+            raise CommandError(u"Shards %s failed to import after %s attempts; their errors "
+                               u"are recorded on the shards" %
+                               (u", ".join(unicode(shard) for shard in failed), MAX_ATTEMPTS))
+
+    def enqueue(self):
+        """
+        Queue an import of data updated since the last import, for workers on any node to
+        do
+        """
+        import_runner = self.get_runner()
+        try:
+            jobs = queue_import(import_runner, ImportWatermark.get_watermarks())
+        finally:
+            import_runner.api.transport.close()
+
+        if jobs is None:
+            raise CommandError(u"An import is already queued")
+        self.stdout.write(u"Import queued as %s jobs" % len(jobs))
+
+    def work(self):
+        """
+        Do queued import jobs until there are none left
+        """
+        import_runner = self.get_runner()
+        name = u"%s:%s" % (socket.gethostname(), os.getpid())
+        try:
+            done = run_worker(import_runner, name, get_claim_timeout())
+        finally:
+            import_runner.api.transport.close()
+
+        for line in import_runner.get_summary():
+            self.stdout.write(line)
+        self.stdout.write(u"%s import jobs done" % done)
+
+    def daemon(self, interval, refresh_interval):
+        """
+        Import changes every ``interval`` seconds until stopped
+
+        @param float interval
+        @param float refresh_interval
+        """
+        import_runner = self.get_runner()
+        self.stdout.write(u"Importing changes every %s seconds" % interval)
+        try:
+            ImportDaemon(import_runner, interval, refresh_interval=refresh_interval).run()
+        finally:
+            import_runner.api.transport.close()
+        self.stdout.write(u"Stopped")
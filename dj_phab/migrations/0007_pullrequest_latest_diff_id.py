@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_phab', '0006_auto_20150327_2228'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pullrequest',
+            name='latest_diff_id',
+            field=models.PositiveIntegerField(help_text='ID of the newest diff whose files have been imported', null=True, blank=True),
+        ),
+    ]
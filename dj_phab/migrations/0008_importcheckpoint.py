@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_phab', '0007_pullrequest_latest_diff_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('entity', models.CharField(unique=True, max_length=32)),
+                ('position', models.CharField(help_text='Offset or cursor to resume paging from', max_length=255, blank=True)),
+                ('watermark', models.DateTimeField(help_text='Only records modified since this time are being imported', null=True, blank=True)),
+                ('started', models.DateTimeField(help_text='When the import began')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_phab', '0008_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportShard',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('start_id', models.PositiveIntegerField(help_text='First diff ID in the shard')),
+                ('end_id', models.PositiveIntegerField(help_text='Diff ID after the last in the shard')),
+                ('status', models.SmallIntegerField(default=0, choices=[(0, 'Pending'), (1, 'Claimed'), (2, 'Done'), (3, 'Failed')])),
+                ('claimed_by', models.CharField(max_length=255, blank=True)),
+                ('claimed_at', models.DateTimeField(null=True, blank=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('retry_after', models.DateTimeField(help_text='Not to be retried before this time', null=True, blank=True)),
+            ],
+            options={
+                'ordering': ['start_id'],
+            },
+        ),
+    ]
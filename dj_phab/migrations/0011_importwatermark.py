@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+ENTITIES = ('users', 'projects', 'repositories', 'pull requests')
+
+
+def copy_last_import_time(apps, schema_editor):
+    LastImportTracker = apps.get_model('dj_phab', 'LastImportTracker')
+    ImportWatermark = apps.get_model('dj_phab', 'ImportWatermark')
+    tracker = LastImportTracker.objects.filter(pk=1).first()
+    if tracker is not None:
+        # users, projects and repositories used to be fetched in full, so everything
+        # modified before the last import has been imported
+        ImportWatermark.objects.bulk_create([
+            ImportWatermark(entity=entity, modified=tracker.last_import_time)
+            for entity in ENTITIES])
+
+
+def copy_pull_requests_watermark(apps, schema_editor):
+    LastImportTracker = apps.get_model('dj_phab', 'LastImportTracker')
+    ImportWatermark = apps.get_model('dj_phab', 'ImportWatermark')
+    watermark = ImportWatermark.objects.filter(entity='pull requests',
+                                               modified__isnull=False).first()
+    if watermark is not None:
+        LastImportTracker.objects.create(pk=1, last_import_time=watermark.modified)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_phab', '0010_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportWatermark',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('entity', models.CharField(unique=True, max_length=32)),
+                ('modified', models.DateTimeField(help_text='Data modified before this time has been imported', null=True, blank=True)),
+                ('cursor', models.CharField(help_text='Position in a stream of changes up to which data has been imported', max_length=255, blank=True)),
+            ],
+            options={
+                'ordering': ['entity'],
+            },
+        ),
+        migrations.RunPython(copy_last_import_time, copy_pull_requests_watermark),
+        migrations.DeleteModel(
+            name='LastImportTracker',
+        ),
+    ]
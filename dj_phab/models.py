@@ -6,7 +6,11 @@ Where we also store created/modified fields corresponding to data in the Phabric
 we give those fields different names (e.g. "date_opened" and "date_updated" for PullRequest)
 """
 
+import json
+from datetime import timedelta
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from dj_phab.queryset import DateGroupingQuerySet
 from model_utils import Choices
 from model_utils.models import TimeStampedModel
@@ -131,6 +135,9 @@ class PullRequest(TimeStampedModel, PhabModel):
     status = models.SmallIntegerField(choices=STATUS)
     uri = models.URLField()
     diff_count = models.PositiveSmallIntegerField()
+    latest_diff_id = models.PositiveIntegerField(null=True, blank=True,
+                                                 help_text=u"ID of the newest diff whose "
+                                                           u"files have been imported")
     commit_count = models.PositiveSmallIntegerField()
     date_opened = models.DateTimeField()
     date_updated = models.DateTimeField()
@@ -150,28 +157,214 @@ class PullRequest(TimeStampedModel, PhabModel):
         ordering = ['-date_opened',]
 
 
-class LastImportTracker(models.Model):
+class ImportWatermark(models.Model):
     """
-    This is a singleton -- only one row permitted.
+    How far imports of each type of data have got: everything modified before ``modified``
+    has been imported.  Imports only ask Phabricator for what changed since then.
     """
-    last_import_time = models.DateTimeField()
+    USERS = 'users'
+    PROJECTS = 'projects'
+    REPOSITORIES = 'repositories'
+    PULL_REQUESTS = 'pull requests'
+    ENTITIES = (USERS, PROJECTS, REPOSITORIES, PULL_REQUESTS)
+    # Position in the feed, as a chronological key, for feed-driven imports
+    FEED = 'feed'
+
+    entity = models.CharField(max_length=32, unique=True)
+    modified = models.DateTimeField(null=True, blank=True,
+                                    help_text=u"Data modified before this time has been "
+                                              u"imported")
+    cursor = models.CharField(max_length=255, blank=True,
+                              help_text=u"Position in a stream of changes up to which data "
+                                        u"has been imported")
 
-    def save(self, *args, **kwargs):
-        self.pk = 1
-        super(LastImportTracker, self).save()
+    def __unicode__(self):
+        return self.entity
+
+    class Meta:
+        ordering = ['entity',]
 
     @classmethod
-    def get_last_import_time(cls):
-        try:
-            return cls.objects.get(pk=1).last_import_time
-        except cls.DoesNotExist:
-            return None
+    def get_watermarks(cls):
+        """
+        @return dict<str, datetime.datetime> Watermarks keyed by entity; entities that
+            have never been imported are left out
+        """
+        return dict((watermark.entity, watermark.modified)
+                    for watermark in cls.objects.filter(modified__isnull=False))
+
+    @classmethod
+    def get_watermark(cls, entity):
+        """
+        @param str entity
+        @return datetime.datetime|None
+        """
+        return cls.get_watermarks().get(entity)
 
     @classmethod
-    def update_last_import_time(cls, new_time):
+    def update_watermarks(cls, modified, entities=ENTITIES):
+        """
+        @param datetime.datetime modified
+        @param iterable<str> entities Entities whose watermarks to move; defaults to all
+        """
+        for entity in entities:
+            cls.objects.update_or_create(entity=entity, defaults={'modified': modified})
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Progress of a chunked import that hasn't finished yet, so that it can be resumed where
+    it stopped.  One row per type of data imported; removed once its import completes.
+    """
+    PULL_REQUESTS = 'pull requests'
+
+    entity = models.CharField(max_length=32, unique=True)
+    position = models.CharField(max_length=255, blank=True,
+                                help_text=u"Offset or cursor to resume paging from")
+    watermark = models.DateTimeField(null=True, blank=True,
+                                     help_text=u"Only records modified since this time are "
+                                               u"being imported")
+    started = models.DateTimeField(help_text=u"When the import began")
+
+    @classmethod
+    def get_checkpoint(cls, entity, watermark=None, started=None):
+        """
+        Fetch the checkpoint of an unfinished import, or start a new one
+
+        @param str entity
+        @param datetime.datetime watermark Used for a new checkpoint
+        @param datetime.datetime started Used for a new checkpoint
+        @return ImportCheckpoint Unsaved if new
+        """
         try:
-            tracker = cls.objects.get(pk=1)
+            return cls.objects.get(entity=entity)
         except cls.DoesNotExist:
-            tracker = cls()
-        tracker.last_import_time = new_time
-        tracker.save()
+            return cls(entity=entity, watermark=watermark, started=started)
+
+
+class ClaimableModel(TimeStampedModel):
+    """
+    A unit of import work that workers, possibly on different machines, claim one at a
+    time.  Workers renew their claims as they go; a unit whose claim hasn't been renewed
+    for a while is assumed to belong to a crashed worker, and can be claimed again.  A
+    failed unit isn't claimed again until its ``retry_after`` time.
+    """
+    STATUS = Choices(
+        (0, 'pending', u"Pending"),
+        (1, 'claimed', u"Claimed"),
+        (2, 'done', u"Done"),
+        (3, 'failed', u"Failed"),
+    )
+
+    status = models.SmallIntegerField(choices=STATUS, default=STATUS.pending)
+    claimed_by = models.CharField(max_length=255, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    retry_after = models.DateTimeField(null=True, blank=True,
+                                       help_text=u"Not to be retried before this time")
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_claimable(cls, stale_after):
+        """
+        @param int stale_after Seconds after which an unrenewed claim expires
+        @return QuerySet Units that are pending and due, or whose claim has expired
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=stale_after)
+        due = Q(retry_after__isnull=True) | Q(retry_after__lte=now)
+        return cls.objects.filter(Q(status=cls.STATUS.pending) & due |
+                                  Q(status=cls.STATUS.claimed, claimed_at__lt=expired))
+
+    @classmethod
+    def claim(cls, worker, stale_after):
+        """
+        Claim the first claimable unit.  Claims are made with a conditional update, so two
+        workers can't claim the same unit; a worker that loses a race simply tries the next
+        unit.
+
+        @param str worker Name of the claiming worker
+        @param int stale_after Seconds after which an unrenewed claim expires
+        @return ClaimableModel|None The claimed unit, or None if there's nothing to claim
+        """
+        claim = dict(status=cls.STATUS.claimed, claimed_by=worker, claimed_at=timezone.now(),
+                     attempts=models.F('attempts') + 1)
+
+        while True:
+            pks = cls.get_claimable(stale_after).values_list('pk', flat=True)[:1]
+            if not pks:
+                return None
+
+            if cls.get_claimable(stale_after).filter(pk=pks[0]).update(**claim):
+                return cls.objects.get(pk=pks[0])
+            # another worker got there first; try the next one
+
+    def renew(self):
+        """
+        Renew the claim, so the unit isn't taken for a crashed worker's
+        """
+        self.claimed_at = timezone.now()
+        type(self).objects.filter(pk=self.pk).update(claimed_at=self.claimed_at)
+
+    def finish(self):
+        self.status = self.STATUS.done
+        type(self).objects.filter(pk=self.pk).update(status=self.status)
+
+    def fail(self, error, max_attempts, retry_delay=0):
+        """
+        Record an error, and give up the claim so that the unit is retried, unless it has
+        been attempted ``max_attempts`` times already.  Retries back off exponentially.
+
+        @param str error
+        @param int max_attempts
+        @param float retry_delay Seconds to wait before the first retry; doubles with every
+            further retry
+        """
+        self.error = error
+        if self.attempts >= max_attempts:
+            self.status = self.STATUS.failed
+        else:
+            self.status = self.STATUS.pending
+            self.retry_after = timezone.now() + timedelta(
+                seconds=retry_delay * 2 ** max(0, self.attempts - 1))
+        type(self).objects.filter(pk=self.pk).update(status=self.status, error=self.error,
+                                                     retry_after=self.retry_after)
+
+
+class ImportShard(ClaimableModel):
+    """
+    A range of diff IDs to be imported by a backfill
+    """
+    start_id = models.PositiveIntegerField(help_text=u"First diff ID in the shard")
+    end_id = models.PositiveIntegerField(help_text=u"Diff ID after the last in the shard")
+
+    def __unicode__(self):
+        return u"D%s-D%s" % (self.start_id, self.end_id - 1)
+
+    class Meta:
+        ordering = ['start_id',]
+
+
+class ImportJob(ClaimableModel):
+    """
+    A unit of work in a queued import, which a worker on any node can claim.  Parameters
+    of the work are stored as JSON in ``payload``.
+    """
+    KIND = Choices(
+        ('diffs', u"Import a batch of diffs"),
+    )
+
+    kind = models.CharField(max_length=32, choices=KIND)
+    payload = models.TextField(default=u"{}")
+
+    def __unicode__(self):
+        return u"%s %s" % (self.kind, self.payload)
+
+    class Meta:
+        ordering = ['pk',]
+
+    def get_payload(self):
+        return json.loads(self.payload)
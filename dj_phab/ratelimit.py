@@ -0,0 +1,84 @@
+"""
+Client-side rate limiting for Conduit calls
+"""
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket allowing ``rate`` calls per second on average, with bursts of up to
+    ``burst`` calls.  Safe to share between threads: each caller reserves a token and then
+    blocks until its token is due, so waiting threads are served in turn rather than
+    each pacing itself.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep, **kwargs):
+        """
+        @param float rate Tokens added per second
+        @param int burst Maximum tokens held at once; defaults to one second's worth
+        @param callable clock Returns the current time in seconds
+        @param callable sleep Function used to wait for a token
+        """
+        super(TokenBucket, self).__init__(**kwargs)
+        if rate <= 0:
+            raise ValueError('Rate must be greater than 0.')
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token, going into debt if none are available
+
+        @return float seconds the caller must wait before using its token
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Block until a token is available
+        """
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Per-method token buckets.  Methods with their own limit get their own bucket; all
+    others share the 'default' bucket, if one is configured.
+    """
+
+    DEFAULT = 'default'
+
+    def __init__(self, limits=None, **kwargs):
+        """
+        @param dict limits Calls per second keyed by Conduit method name
+            (e.g. 'differential.getcommitpaths'), or 'default' for all other methods.
+            Methods without a limit aren't limited.
+        """
+        super(RateLimiter, self).__init__(**kwargs)
+        self.buckets = dict((method, TokenBucket(rate))
+                            for method, rate in (limits or {}).items() if rate)
+
+    def acquire(self, method):
+        """
+        Block until a call to ``method`` is allowed
+
+        @param str method Conduit method name
+        """
+        bucket = self.buckets.get(method, self.buckets.get(self.DEFAULT))
+        if bucket is not None:
+            bucket.acquire()
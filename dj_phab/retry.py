@@ -0,0 +1,148 @@
+"""
+Retry and circuit-breaking policy for Conduit calls
+"""
+import logging
+import random
+import socket
+import threading
+import time
+from django.utils.six.moves import http_client
+
+
+# Errors that indicate a transient network or server problem, as opposed to e.g. a
+# Conduit APIError caused by a bad request
+RETRYABLE_ERRORS = (socket.error, IOError, http_client.HTTPException)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a failing service for a while, rather than letting every caller keep
+    retrying against it.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and every call is
+    rejected with `CircuitOpenError` for ``reset_timeout`` seconds.  After that a single
+    trial call is let through, while other calls keep being rejected: success closes the
+    circuit, failure opens it again.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, failure_threshold=10, reset_timeout=60, clock=time.time, **kwargs):
+        """
+        @param int failure_threshold Consecutive failures before the circuit opens
+        @param float reset_timeout Seconds to reject calls for once the circuit opens
+        @param callable clock Returns the current time in seconds
+        """
+        super(CircuitBreaker, self).__init__(**kwargs)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._failures = 0
+        self._opened_at = None
+        # whether a trial call is in progress
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self):
+        """
+        Raise `CircuitOpenError` if calls are currently being rejected
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            remaining = self.reset_timeout - (self.clock() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(u"Circuit open after %s consecutive failures; "
+                                       u"retry in %.1f seconds" % (self._failures, remaining))
+            if self._probing:
+                raise CircuitOpenError(u"Circuit open after %s consecutive failures; "
+                                       u"waiting for a trial call" % self._failures)
+
+            # half-open: let one trial call through
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+            self._probing = False
+
+
+class RetryPolicy(object):
+    """
+    Retries calls that fail with transient errors, with exponential backoff and "full"
+    jitter, and guards them all with a shared `CircuitBreaker`
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, failure_threshold=10,
+                 reset_timeout=60, retry_on=RETRYABLE_ERRORS, sleep=time.sleep, **kwargs):
+        """
+        @param int max_attempts Total attempts per call, including the first
+        @param float base_delay Upper bound of the delay in seconds before the first retry;
+            doubles with every further retry
+        @param float max_delay Upper bound of the delay in seconds before any retry
+        @param int failure_threshold See `CircuitBreaker`
+        @param float reset_timeout See `CircuitBreaker`
+        @param tuple<Exception> retry_on Exception classes that should be retried
+        @param callable sleep Function used to wait between attempts
+        """
+        super(RetryPolicy, self).__init__(**kwargs)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.sleep = sleep
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def get_delay(self, attempt):
+        """
+        @param int attempt Number of attempts made so far
+        @return float seconds to wait before the next attempt
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call ``func`` with the given arguments, retrying transient errors
+
+        @param callable func
+        @return any Return value of ``func``
+        """
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_call()
+            attempt += 1
+            try:
+                result = func(*args, **kwargs)
+            except self.retry_on as error:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.max_attempts:
+                    raise
+                delay = self.get_delay(attempt)
+                logging.warning('attempt %s failed with %r; retrying in %.2f seconds' %
+                                (attempt, error, delay))
+                self.sleep(delay)
+            except Exception:
+                # e.g. an APIError: the service answered, so it isn't failing
+                self.circuit_breaker.record_success()
+                raise
+            else:
+                self.circuit_breaker.record_success()
+                return result
@@ -3,11 +3,20 @@ from mock import Mock, MagicMock
 
 def prep_phab_mocks():
     phabricator = MagicMock()
-    phabricator.user.query = MagicMock(return_value=get_dummy_users())
-    phabricator.project.query = MagicMock(return_value=get_dummy_projects())
-    phabricator.repository.query = MagicMock(return_value=get_dummy_repos())
+    phabricator.user.query = MagicMock(side_effect=get_paged_users)
+    phabricator.project.query = MagicMock(side_effect=get_paged_projects)
+    phabricator.repository.query = MagicMock(side_effect=get_paged_repos)
+    phabricator.user.search = MagicMock(
+        side_effect=search_modified(get_dummy_users().response))
+    phabricator.project.search = MagicMock(
+        side_effect=search_modified(get_dummy_projects().response['data'].values()))
+    phabricator.diffusion.repository.search = MagicMock(
+        side_effect=search_modified(get_dummy_repos().response))
     phabricator.differential.query = MagicMock(side_effect=get_batched_diffs)
+    phabricator.differential.revision.search = MagicMock(side_effect=get_cursor_diffs)
     phabricator.differential.getcommitpaths = MagicMock(return_value=get_dummy_files())
+    phabricator.differential.querydiffs = MagicMock(side_effect=get_dummy_querydiffs)
+    phabricator.feed.query = MagicMock(side_effect=get_feed)
 
     return phabricator
 
@@ -22,8 +31,16 @@ class ResponseWrapper(object):
         super(ResponseWrapper, self).__init__(*args, **kwargs)
 
 
-def get_batched_diffs(order=None, limit=None, offset=0):
-    diffs = get_dummy_diffs(order)
+def get_batched_diffs(order=None, limit=None, offset=0, ids=None, phids=None):
+    if ids is not None:
+        # Lookups by ID follow a revision.search, so use the same data it enumerates
+        diffs = get_dummy_diffs('order-modified')
+        diffs = dict((key, diff) for key, diff in diffs.items() if int(diff['id']) in ids)
+    elif phids is not None:
+        diffs = get_dummy_diffs('order-modified')
+        diffs = dict((key, diff) for key, diff in diffs.items() if diff['phid'] in phids)
+    else:
+        diffs = get_dummy_diffs(order)
 
     # This is a PITA becase we have to slice a dict in a consistent manner
     if order:
@@ -44,6 +61,192 @@ def get_batched_diffs(order=None, limit=None, offset=0):
 
     return ResponseWrapper([diffs[key] for key in keys_to_retrieve])
 
+def get_cursor_diffs(constraints=None, order=None, after=None, limit=100, **kwargs):
+    """
+    Stand-in for ``differential.revision.search``: returns diffs ordered by date modified
+    (descending), constrained by ``modifiedStart``, paged with an ``after`` cursor
+    """
+    constraints = constraints or {}
+    diffs = sorted(get_dummy_diffs('order-modified').values(),
+                   key=lambda diff: (int(diff['dateModified']), int(diff['id'])), reverse=True)
+
+    if 'modifiedStart' in constraints:
+        diffs = [diff for diff in diffs
+                 if int(diff['dateModified']) >= constraints['modifiedStart']]
+
+    if after is not None:
+        # the cursor is the ID of the last row on the previous page
+        ids = [diff['id'] for diff in diffs]
+        diffs = diffs[ids.index(after) + 1:]
+
+    page = diffs[:limit]
+    return ResponseWrapper({
+        'data': [{
+            'id': int(diff['id']),
+            'phid': diff['phid'],
+            'fields': {'dateModified': int(diff['dateModified'])},
+        } for diff in page],
+        'cursor': {
+            'limit': limit,
+            'after': page[-1]['id'] if len(diffs) > limit else None,
+            'before': None,
+            'order': order,
+        },
+    })
+
+def search_modified(records):
+    """
+    Make a stand-in for a ``*.search`` method over ``records``, which finds those modified
+    at or after the ``modifiedStart`` constraint.  Records without a ``dateModified`` are
+    never found.
+    """
+    def search(constraints=None, after=None, limit=100, **kwargs):
+        start = (constraints or {}).get('modifiedStart', 0)
+        matches = sorted((record for record in records
+                          if int(record.get('dateModified', -1)) >= start),
+                         key=lambda record: record['phid'])
+        offset = int(after or 0)
+        page = matches[offset:offset + limit]
+        return ResponseWrapper({
+            'data': [{'phid': record['phid']} for record in page],
+            'cursor': {
+                'after': str(offset + limit) if len(matches) > offset + limit else None,
+            },
+        })
+
+    return search
+
+def get_paged_users(offset=0, limit=None, phids=None, **kwargs):
+    users = sorted(get_dummy_users().response, key=lambda user: user['userName'])
+    if phids is not None:
+        users = [user for user in users if user['phid'] in phids]
+    end = offset + limit if limit else None
+    return ResponseWrapper(users[offset:end])
+
+def get_paged_projects(offset=0, limit=None, phids=None, **kwargs):
+    response = get_dummy_projects().response
+    phids = sorted(phid for phid in response['data'] if phids is None or phid in phids)
+    end = offset + limit if limit else None
+    # like Phabricator, an empty page's data is a list
+    response['data'] = dict((phid, response['data'][phid]) for phid in phids[offset:end]) \
+        or []
+    return ResponseWrapper(response)
+
+def get_paged_repos(after=None, limit=None, phids=None, **kwargs):
+    # repository.query returns newest first; ``after`` is the ID of the last repo seen
+    repos = sorted(get_dummy_repos().response, key=lambda repo: int(repo['id']), reverse=True)
+    if phids is not None:
+        repos = [repo for repo in repos if repo['phid'] in phids]
+    if after is not None:
+        repos = [repo for repo in repos if int(repo['id']) < int(after)]
+    return ResponseWrapper(repos[:limit] if limit else repos)
+
+def get_feed(before=None, after=None, limit=100, **kwargs):
+    """
+    Stand-in for ``feed.query``, which lists stories newest first: ``before`` gives the
+    stories just newer than a chronological key, ``after`` those just older
+    """
+    stories = sorted(get_dummy_feed().items(),
+                     key=lambda item: int(item[1]['chronologicalKey']))
+    if before is not None:
+        stories = [item for item in stories
+                   if int(item[1]['chronologicalKey']) > int(before)][:limit]
+    else:
+        if after is not None:
+            stories = [item for item in stories
+                       if int(item[1]['chronologicalKey']) < int(after)]
+        stories = stories[-limit:]
+    return ResponseWrapper(dict(stories))
+
+def get_dummy_feed():
+    """
+    ``feed.query`` results in its default 'data' view, keyed by story PHID
+    """
+    return json.loads('''
+        {
+          "PHID-STRY-5aitn3uy4e6d4b2alkbh" : {
+            "class"            : "PhabricatorApplicationTransactionFeedStory",
+            "epoch"            : 1426606652,
+            "authorPHID"       : "PHID-USER-thi47riaglakoejlabla",
+            "chronologicalKey" : "6127391856389162311",
+            "data"             : {
+              "objectPHID"       : "PHID-DREV-bxdze45ass5m3fhsiji2",
+              "transactionPHIDs" : {
+                "PHID-XACT-DREV-2ksmdhbxlzdkhyf" : "PHID-XACT-DREV-2ksmdhbxlzdkhyf"
+              }
+            }
+          },
+          "PHID-STRY-gyr3w7imcpvhfzgf6jmp" : {
+            "class"            : "PhabricatorApplicationTransactionFeedStory",
+            "epoch"            : 1426606765,
+            "authorPHID"       : "PHID-USER-froe3pl0phoe6lap2oer",
+            "chronologicalKey" : "6127392341536946285",
+            "data"             : {
+              "objectPHID"       : "PHID-TASK-c3sq6kuh3x27bhhqzmjz",
+              "transactionPHIDs" : {
+                "PHID-XACT-TASK-qm7ye2lhdtwo3ch" : "PHID-XACT-TASK-qm7ye2lhdtwo3ch"
+              }
+            }
+          },
+          "PHID-STRY-rnmiuqnqzdjljxnbd3rl" : {
+            "class"            : "PhabricatorApplicationTransactionFeedStory",
+            "epoch"            : 1426606943,
+            "authorPHID"       : "PHID-USER-froe3pl0phoe6lap2oer",
+            "chronologicalKey" : "6127393104829548092",
+            "data"             : {
+              "objectPHID"       : "PHID-PROJ-hh55htv4ejajjtssl63x",
+              "transactionPHIDs" : {
+                "PHID-XACT-PROJ-uvrpaa6r7mbsbtt" : "PHID-XACT-PROJ-uvrpaa6r7mbsbtt"
+              }
+            }
+          },
+          "PHID-STRY-qpkhgfqv6yovgkxmjqtd" : {
+            "class"            : "PhabricatorApplicationTransactionFeedStory",
+            "epoch"            : 1426608592,
+            "authorPHID"       : "PHID-USER-c0ieboustiagouxlex90",
+            "chronologicalKey" : "6127400188913702644",
+            "data"             : {
+              "objectPHID"       : "PHID-DREV-evimsdp6ol7ydgbh4hna",
+              "transactionPHIDs" : {
+                "PHID-XACT-DREV-wz5sfo4bjdeukbd" : "PHID-XACT-DREV-wz5sfo4bjdeukbd"
+              }
+            }
+          },
+          "PHID-STRY-t6ex6dafr4fmjrfkrp7x" : {
+            "class"            : "PhabricatorApplicationTransactionFeedStory",
+            "epoch"            : 1426608651,
+            "authorPHID"       : "PHID-USER-thi47riaglakoejlabla",
+            "chronologicalKey" : "6127400442326152519",
+            "data"             : {
+              "objectPHID"       : "PHID-DREV-evimsdp6ol7ydgbh4hna",
+              "transactionPHIDs" : {
+                "PHID-XACT-DREV-6pdzuxcxs2fv7ik" : "PHID-XACT-DREV-6pdzuxcxs2fv7ik"
+              }
+            }
+          }
+        }
+    ''')
+
+def get_dummy_querydiffs(ids=None, revisionIDs=None, **kwargs):
+    """
+    Stand-in for ``differential.querydiffs``: every diff changes the dummy files
+    """
+    revisions = get_dummy_diffs(None).values() + get_dummy_diffs('order-modified').values()
+    paths = get_dummy_files().response
+    diffs = {}
+
+    for revision in revisions:
+        for diff_id in revision['diffs']:
+            if (ids and int(diff_id) in ids) or \
+                    (revisionIDs and int(revision['id']) in revisionIDs):
+                diffs[diff_id] = {
+                    'id': diff_id,
+                    'revisionID': revision['id'],
+                    'changes': [{'currentPath': path, 'oldPath': None} for path in paths],
+                }
+
+    return ResponseWrapper(diffs)
+
 def get_dummy_users(*args, **kwargs):
     return ResponseWrapper(json.loads('''
         {
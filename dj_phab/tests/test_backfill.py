@@ -0,0 +1,106 @@
+import datetime
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+from dj_phab.backfill import MAX_ATTEMPTS, plan_shards, run_worker
+from dj_phab.conduit import ConduitAPI
+from dj_phab.importer import ImportRunner, PullRequestImporter
+from dj_phab.models import ImportShard, PullRequest, UpdatedFile
+from dj_phab.tests import _test_data as test_data
+from phabricator import APIError
+
+
+class TestBackfill(TestCase):
+    def setUp(self):
+        phabricator = test_data.prep_phab_mocks()
+        conduit = ConduitAPI(phabricator, 2)
+        self.runner = ImportRunner(conduit)
+        self.runner.import_reference_data()
+
+    def test_smoke(self):
+        pass
+
+    def test_plan_shards(self):
+        self.assertEqual(plan_shards(self.runner.api, 1000), 2)
+
+        shards = ImportShard.objects.all()
+        self.assertEqual([(shard.start_id, shard.end_id) for shard in shards],
+                         [(1, 1001), (1001, 1467)])
+
+    def test_plan_shards_keeps_unfinished(self):
+        ImportShard.objects.create(start_id=1, end_id=11, status=ImportShard.STATUS.done)
+        ImportShard.objects.create(start_id=11, end_id=21)
+
+        self.assertEqual(plan_shards(self.runner.api, 1000), 1)
+        self.assertEqual(ImportShard.objects.count(), 2)
+
+    def test_plan_shards_once(self):
+        ImportShard.objects.create(start_id=1, end_id=11, status=ImportShard.STATUS.done)
+        ImportShard.objects.create(start_id=11, end_id=21, status=ImportShard.STATUS.failed)
+
+        # the backfill is done, so nothing is planned again
+        self.assertEqual(plan_shards(self.runner.api, 1000), 0)
+        self.assertEqual(ImportShard.objects.count(), 2)
+        self.assertEqual(self.runner.api.phabricator.differential.query.call_count, 0)
+
+    def test_claim(self):
+        first = ImportShard.objects.create(start_id=1, end_id=11)
+        second = ImportShard.objects.create(start_id=11, end_id=21)
+
+        self.assertEqual(ImportShard.claim('a', 600), first)
+        claimed = ImportShard.claim('b', 600)
+        self.assertEqual(claimed, second)
+        self.assertEqual(claimed.claimed_by, 'b')
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(ImportShard.claim('c', 600))
+
+    def test_claim_stale(self):
+        shard = ImportShard.objects.create(start_id=1, end_id=11)
+        ImportShard.claim('crashed', 600)
+        ImportShard.objects.filter(pk=shard.pk).update(
+            claimed_at=timezone.now() - datetime.timedelta(seconds=601))
+
+        reclaimed = ImportShard.claim('b', 600)
+
+        self.assertEqual(reclaimed, shard)
+        self.assertEqual(reclaimed.claimed_by, 'b')
+        self.assertEqual(reclaimed.attempts, 2)
+
+    def test_run_worker(self):
+        plan_shards(self.runner.api, 1000)
+
+        self.assertEqual(run_worker(self.runner, 'a', 600), 2)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertFalse(ImportShard.objects.exclude(status=ImportShard.STATUS.done).exists())
+
+    def test_run_worker_retries_failed_shard(self):
+        ImportShard.objects.create(start_id=1460, end_id=1467)
+        self.runner.api.phabricator.differential.query.side_effect = \
+            APIError('ERR-CONDUIT-CORE', 'Something broke')
+
+        self.assertEqual(run_worker(self.runner, 'a', 600, retry_delay=0), 0)
+
+        shard = ImportShard.objects.get()
+        self.assertEqual(shard.status, ImportShard.STATUS.failed)
+        self.assertEqual(shard.attempts, MAX_ATTEMPTS)
+        self.assertIn('Something broke', shard.error)
+
+    def test_failed_shard_resets_caches(self):
+        ImportShard.objects.create(start_id=1460, end_id=1467)
+        convert_records = PullRequestImporter.convert_records
+        calls = []
+        def fail_first_page(*args, **kwargs):
+            # after the page's files are saved, so that they're rolled back
+            calls.append(1)
+            if len(calls) == 1:
+                raise APIError('ERR-CONDUIT-CORE', 'Something broke')
+            return convert_records(*args, **kwargs)
+
+        with patch.object(PullRequestImporter, 'convert_records', side_effect=fail_first_page):
+            self.assertEqual(run_worker(self.runner, 'a', 600, retry_delay=0), 1)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(set(PullRequest.files.through.objects.values_list('updatedfile_id',
+                                                                           flat=True)),
+                         set(UpdatedFile.objects.values_list('pk', flat=True)))
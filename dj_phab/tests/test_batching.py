@@ -0,0 +1,62 @@
+import time
+from django.test import TestCase
+from mock import MagicMock
+from dj_phab.batching import AdaptiveBatchSize
+from dj_phab.conduit import ConduitAPI
+from dj_phab.tests import _test_data as test_data
+
+
+class TestAdaptiveBatchSize(TestCase):
+    def setUp(self):
+        self.sizer = AdaptiveBatchSize(50, min_size=10, max_size=500, target_seconds=2.0,
+                                       max_bytes=100000)
+
+    def test_smoke(self):
+        pass
+
+    def test_grows_when_fast(self):
+        self.assertEqual(self.sizer.record(50, 0.5, 1000), 100)
+        self.assertEqual(self.sizer.record(100, 0.5, 2000), 200)
+
+    def test_shrinks_when_slow(self):
+        self.assertEqual(self.sizer.record(50, 4.0, 1000), 25)
+
+    def test_shrinks_when_large(self):
+        self.assertEqual(self.sizer.record(50, 0.1, 200000), 25)
+
+    def test_respects_bounds(self):
+        for i in range(10):
+            self.sizer.record(self.sizer.size, 100.0, 1000)
+        self.assertEqual(self.sizer.size, 10)
+
+        for i in range(10):
+            self.sizer.record(self.sizer.size, 0.001, 1)
+        self.assertEqual(self.sizer.size, 500)
+
+    def test_ignores_empty_pages(self):
+        self.assertEqual(self.sizer.record(0, 10.0, 0), 50)
+
+    def test_conduit_uses_adapted_size(self):
+        phabricator = test_data.prep_phab_mocks()
+        conduit = ConduitAPI(phabricator, 2,
+                             batch_sizer=AdaptiveBatchSize(2, min_size=1, max_size=4))
+
+        prs = conduit.fetch_pull_requests()
+
+        self.assertEqual(len(prs), 5)
+        limits = [call[1]['limit'] for call in phabricator.differential.query.call_args_list]
+        self.assertEqual(limits, [2, 4])
+
+    def test_conduit_times_requests_only(self):
+        phabricator = test_data.prep_phab_mocks()
+        sizer = AdaptiveBatchSize(2, min_size=1, max_size=4)
+        sizer.record = MagicMock(return_value=2)
+        rate_limiter = MagicMock()
+        rate_limiter.acquire.side_effect = lambda method: time.sleep(0.2)
+        conduit = ConduitAPI(phabricator, 2, batch_sizer=sizer, rate_limiter=rate_limiter)
+
+        conduit.fetch_pull_requests()
+
+        # waits for the rate limiter don't count as time taken by the page
+        for call in sizer.record.call_args_list:
+            self.assertLess(call[0][1], 0.1)
@@ -0,0 +1,98 @@
+import threading
+from django.test import TestCase
+from dj_phab.concurrency import map_stream, measure, prefetch, StageStats
+
+
+class TestMapStream(TestCase):
+    def test_smoke(self):
+        pass
+
+    def test_map_stream(self):
+        results = list(map_stream(lambda x: x * 2, range(10), workers=3))
+        self.assertEqual(results, [x * 2 for x in range(10)])
+
+    def test_map_stream_backpressure(self):
+        consumed = []
+        def items():
+            for x in range(10):
+                consumed.append(x)
+                yield x
+
+        results = map_stream(lambda x: x, items(), workers=2, depth=1)
+        self.assertEqual(next(results), 0)
+        # only workers + depth items are taken before the first result is handed over
+        self.assertEqual(len(consumed), 3)
+        self.assertEqual(list(results), range(1, 10))
+
+    def test_map_stream_reraises(self):
+        def fail_on_3(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        results = map_stream(fail_on_3, range(10), workers=2)
+        self.assertEqual([next(results) for _ in range(3)], [0, 1, 2])
+        with self.assertRaises(ValueError):
+            next(results)
+
+    def test_map_stream_runs_off_thread(self):
+        threads = list(map_stream(lambda x: threading.current_thread(), range(2)))
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+class TestPrefetch(TestCase):
+    def test_smoke(self):
+        pass
+
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(range(5), depth=2)), range(5))
+
+    def test_prefetch_reraises(self):
+        def items():
+            yield 1
+            raise ValueError()
+
+        results = prefetch(items())
+        self.assertEqual(next(results), 1)
+        with self.assertRaises(ValueError):
+            next(results)
+
+    def test_prefetch_stops_with_consumer(self):
+        finished = threading.Event()
+        def items():
+            try:
+                for x in range(100):
+                    yield x
+            finally:
+                finished.set()
+
+        results = prefetch(items())
+        self.assertEqual(next(results), 0)
+        results.close()
+
+        # the producer gives up rather than blocking on a queue nobody reads
+        self.assertTrue(finished.wait(5))
+
+
+class TestStageStats(TestCase):
+    def test_smoke(self):
+        pass
+
+    def test_measure(self):
+        stats = StageStats('fetch')
+
+        self.assertEqual(list(measure([[1, 2], [3]], stats)), [[1, 2], [3]])
+
+        self.assertEqual(stats.batches, 2)
+        self.assertEqual(stats.records, 3)
+
+    def test_rate(self):
+        stats = StageStats('write')
+        self.assertEqual(stats.rate, 0)
+
+        stats.record(10, 2.0)
+        stats.record(20, 1.0)
+
+        self.assertEqual(stats.rate, 10.0)
+        self.assertEqual(stats.get_summary(),
+                         u"Write: 30 records in 2 batches, 3.00 seconds (10.0 records/second)")
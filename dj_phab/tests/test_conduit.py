@@ -1,7 +1,7 @@
 import datetime
 from django.test import TestCase
 from django.utils import timezone
-from dj_phab.conduit import ConduitAPI
+from dj_phab.conduit import ConduitAPI, get_story_object_phid
 from dj_phab.models import PhabUser, Project, Repository, PullRequest
 from dj_phab.tests import _test_data as test_data
 
@@ -37,6 +37,44 @@ class TestConduitAPI(TestCase):
         self.assertEqual(len(anvil_list), 1)
         self.assertEqual(anvil_list[0]['name'], 'Anvil')
 
+    def test_fetch_users_pages(self):
+        users = self.conduit.fetch_users()
+        self.assertItemsEqual([user['userName'] for user in users], ['alice', 'bob', 'carol'])
+        self.assertEqual(self.phabricator.user.query.call_count, 2)
+
+    def test_fetch_projects_concurrently(self):
+        conduit = ConduitAPI(self.phabricator, 2, workers=4)
+        projects = conduit.fetch_projects()
+        self.assertEqual(len(projects), 5)
+        self.assertEqual(len(set(project['phid'] for project in projects)), 5)
+
+    def test_fetch_projects_empty_last_page(self):
+        # the last page is full, so the page after it is fetched and is empty
+        conduit = ConduitAPI(self.phabricator, 5)
+        projects = conduit.fetch_projects()
+        self.assertEqual(len(projects), 5)
+        self.assertEqual(self.phabricator.project.query.call_count, 2)
+        self.assertEqual(self.phabricator.project.query(offset=5, limit=5).response['data'],
+                         [])
+
+    def test_fetch_repositories_pages(self):
+        repos = self.conduit.fetch_repositories()
+        self.assertEqual(len(set(repo['phid'] for repo in repos)), 5)
+        self.assertEqual(self.phabricator.repository.query.call_count, 3)
+
+    def test_fetch_projects_modified_since(self):
+        projects = self.conduit.fetch_projects(
+            modified_since=timezone.make_aware(datetime.datetime.utcfromtimestamp(1409866111),
+                                               timezone.utc))
+        self.assertItemsEqual([project['name'] for project in projects],
+                              ['Acme Inc.', 'LexCorp', 'Sirius Cybernetics'])
+
+    def test_fetch_users_modified_since_unchanged(self):
+        users = self.conduit.fetch_users(modified_since=timezone.now())
+        self.assertEqual(users, [])
+        self.assertEqual(self.phabricator.user.search.call_count, 1)
+        self.assertEqual(self.phabricator.user.query.call_count, 0)
+
     def test_fetch_all_pull_requests(self):
         prs = self.conduit.fetch_pull_requests()
         self.assertEqual(len(prs), 5)
@@ -44,6 +82,30 @@ class TestConduitAPI(TestCase):
         self.assertEqual(len(lightbox_list), 1)
         self.assertIn('clicking outside of lightbox', lightbox_list[0]['title'])
 
+    def test_iter_pull_requests(self):
+        pages = list(self.conduit.iter_pull_requests())
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        ids = [pr['id'] for page in pages for pr in page]
+        self.assertItemsEqual(ids, ['1462', '1463', '1464', '1465', '1466'])
+
+    def test_iter_pull_requests_resume(self):
+        pages = list(self.conduit.iter_pull_requests())
+        self.assertEqual([page.position for page in pages], ['2', '4', '5'])
+
+        resumed = list(self.conduit.iter_pull_requests(position=pages[0].position))
+        self.assertEqual([list(page) for page in resumed], [list(page) for page in pages[1:]])
+
+    def test_fetch_latest_pull_request_id(self):
+        self.assertEqual(self.conduit.fetch_latest_pull_request_id(), 1466)
+
+    def test_iter_pull_requests_by_id(self):
+        pages = list(self.conduit.iter_pull_requests_by_id(1457, 1466))
+
+        # empty pages of IDs are skipped
+        self.assertEqual([page.position for page in pages], ['1461', '1463', '1465', '1466'])
+        ids = [pr['id'] for page in pages for pr in page]
+        self.assertItemsEqual(ids, ['1460', '1462', '1464', '1465'])
+
     def test_fetch_modified_pull_requests(self):
         prs = self.conduit.fetch_pull_requests(
             modified_since=datetime.datetime.fromtimestamp(1426606600))
@@ -55,7 +117,89 @@ class TestConduitAPI(TestCase):
         statuses_list = filter(lambda pr: pr['id'] == '1462', prs)
         self.assertEqual(len(statuses_list), 0)
 
+    def test_fetch_pull_requests_by_phid(self):
+        prs = self.conduit.fetch_pull_requests_by_phid(
+            ['PHID-DREV-evimsdp6ol7ydgbh4hna', 'PHID-DREV-bxdze45ass5m3fhsiji2',
+             'PHID-DREV-unknown0000000000000'])
+        self.assertItemsEqual([pr['id'] for pr in prs], ['1466', '1465'])
+        self.assertEqual(self.phabricator.differential.query.call_count, 2)
+
+    def test_fetch_latest_feed_key(self):
+        self.assertEqual(self.conduit.fetch_latest_feed_key(), '6127400442326152519')
+
+    def test_iter_feed(self):
+        pages = list(self.conduit.iter_feed('6127391856389162311'))
+        self.assertEqual([[get_story_object_phid(story) for story in page] for page in pages], [
+            ['PHID-TASK-c3sq6kuh3x27bhhqzmjz', 'PHID-PROJ-hh55htv4ejajjtssl63x'],
+            ['PHID-DREV-evimsdp6ol7ydgbh4hna', 'PHID-DREV-evimsdp6ol7ydgbh4hna'],
+        ])
+        self.assertEqual([page.position for page in pages],
+                         ['6127393104829548092', '6127400442326152519'])
+
+    def test_get_story_object_phid(self):
+        self.assertEqual(get_story_object_phid({'objectPHID': 'PHID-DREV-1'}), 'PHID-DREV-1')
+        self.assertEqual(get_story_object_phid({'data': {'objectPHID': 'PHID-DREV-1'}}),
+                         'PHID-DREV-1')
+        self.assertIsNone(get_story_object_phid({'data': []}))
+
+    def test_iter_feed_up_to_date(self):
+        self.assertEqual(list(self.conduit.iter_feed('6127400442326152519')), [])
+
     def test_fetch_files(self):
         files = self.conduit.fetch_files(123)
         self.assertEqual(len(files), 4)
         self.assertIn('assets/anvil/campaign/tpls/hammers.html', files)
+
+    def test_fetch_files_for_pull_requests(self):
+        prs = self.conduit.fetch_pull_requests()
+        files = self.conduit.fetch_files_for_pull_requests(prs)
+
+        self.assertItemsEqual(files.keys(), [1462, 1463, 1464, 1465, 1466])
+        self.assertEqual(len(files[1466]), 4)
+        self.assertIn('assets/anvil/campaign/tpls/hammers.html', files[1466])
+
+        # only the latest version of each diff is requested, all at once
+        self.assertEqual(self.phabricator.differential.querydiffs.call_count, 1)
+        self.assertIn(3902, self.phabricator.differential.querydiffs.call_args[1]['ids'])
+
+
+class TestConduitAPICursorPagination(TestCase):
+    def setUp(self):
+        self.phabricator = test_data.prep_phab_mocks()
+        self.conduit = ConduitAPI(self.phabricator, 2, pagination='cursor')
+
+    def test_smoke(self):
+        pass
+
+    def test_fetch_all_pull_requests(self):
+        pages = list(self.conduit.iter_pull_requests())
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        ids = [pr['id'] for page in pages for pr in page]
+        self.assertItemsEqual(ids, ['1460', '1462', '1464', '1465', '1466'])
+
+    def test_iter_pull_requests_resume(self):
+        pages = list(self.conduit.iter_pull_requests())
+        self.assertIsNone(pages[-1].position)
+
+        resumed = list(self.conduit.iter_pull_requests(position=pages[0].position))
+        self.assertEqual([list(page) for page in resumed], [list(page) for page in pages[1:]])
+
+    def test_fetch_modified_pull_requests(self):
+        prs = self.conduit.fetch_pull_requests(
+            modified_since=datetime.datetime.fromtimestamp(1426606600))
+        self.assertItemsEqual([pr['id'] for pr in prs], ['1460', '1465', '1466'])
+
+        # the server does the filtering, so no rows before the watermark are requested
+        for call in self.phabricator.differential.revision.search.call_args_list:
+            self.assertEqual(call[1]['constraints'], {'modifiedStart': 1426606600})
+        self.assertEqual(self.phabricator.differential.revision.search.call_count, 2)
+
+    def test_constraints_not_changed(self):
+        constraints = {'authorPHIDs': ['PHID-USER-c0ieboustiagouxlex90']}
+        self.conduit.fetch_pull_requests(
+            modified_since=datetime.datetime.fromtimestamp(1426606600), constraints=constraints)
+        self.assertEqual(constraints, {'authorPHIDs': ['PHID-USER-c0ieboustiagouxlex90']})
+
+    def test_invalid_pagination(self):
+        with self.assertRaises(ValueError):
+            ConduitAPI(self.phabricator, 2, pagination='sideways')
@@ -0,0 +1,105 @@
+from django.test import TestCase
+from dj_phab.conduit import ConduitAPI
+from dj_phab.daemon import ImportDaemon
+from dj_phab.importer import ImportRunner
+from dj_phab.models import ImportWatermark, PhabUser, PullRequest, UpdatedFile
+from dj_phab.tests import _test_data as test_data
+from phabricator import APIError
+
+
+class TestImportDaemon(TestCase):
+    def setUp(self):
+        phabricator = test_data.prep_phab_mocks()
+        self.runner = ImportRunner(ConduitAPI(phabricator, 2))
+        self.now = 1000.0
+        self.daemon = ImportDaemon(self.runner, interval=10, jitter=0.1, refresh_interval=60,
+                                   clock=lambda: self.now)
+
+    def test_smoke(self):
+        pass
+
+    def test_get_delay(self):
+        for _ in range(20):
+            self.assertTrue(9 <= self.daemon.get_delay() <= 11)
+
+    def test_poll(self):
+        self.daemon.poll()
+
+        self.assertEqual(PhabUser.objects.count(), 3)
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertIsNotNone(ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS))
+
+    def test_poll_refreshes_reference_data_on_interval(self):
+        # later refreshes only search for users modified since the first one
+        user_search = self.runner.api.phabricator.user.search
+
+        self.daemon.poll()
+        self.now += 30
+        self.daemon.poll()
+        self.assertEqual(user_search.call_count, 0)
+
+        self.now += 30
+        self.daemon.poll()
+        self.assertGreater(user_search.call_count, 0)
+
+    def test_poll_keeps_caches(self):
+        self.daemon.poll()
+        identity_map = self.runner.identity_map
+        file_ids = self.runner.file_ids
+
+        self.daemon.poll()
+
+        self.assertIs(self.runner.identity_map, identity_map)
+        self.assertIs(self.runner.file_ids, file_ids)
+        self.assertEqual(self.runner.stats['pull requests']['created'], 0)
+
+    def test_failed_poll_resets_caches(self):
+        query = self.runner.api.phabricator.differential.query
+        def fail_after_first_page(**kwargs):
+            if query.call_count > 1:
+                raise APIError('ERR-CONDUIT-CORE', 'Something broke')
+            return test_data.get_batched_diffs(**kwargs)
+        query.side_effect = fail_after_first_page
+
+        with self.assertRaises(APIError):
+            self.daemon.poll()
+
+        # the first page's users and files were rolled back, so mustn't be reused
+        self.assertEqual(UpdatedFile.objects.count(), 0)
+        self.assertEqual(self.runner.file_ids, {})
+        self.assertEqual(self.runner.identity_map.instances, {})
+
+        query.side_effect = test_data.get_batched_diffs
+        self.daemon.poll()
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(set(PullRequest.files.through.objects.values_list('updatedfile_id',
+                                                                           flat=True)),
+                         set(UpdatedFile.objects.values_list('pk', flat=True)))
+
+    def test_run_until_stopped(self):
+        polls = []
+        def poll():
+            polls.append(1)
+            if len(polls) == 2:
+                self.daemon.stop()
+        self.daemon.poll = poll
+        self.daemon.interval = 0
+
+        self.daemon.run()
+
+        self.assertEqual(len(polls), 2)
+
+    def test_run_survives_failed_poll(self):
+        polls = []
+        def poll():
+            polls.append(1)
+            if len(polls) == 1:
+                raise ValueError()
+            self.daemon.stop()
+        self.daemon.poll = poll
+        self.daemon.interval = 0
+
+        self.daemon.run()
+
+        self.assertEqual(len(polls), 2)
@@ -0,0 +1,41 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+from mock import patch
+from dj_phab.conduit import ConduitAPI
+from dj_phab.importer import ImportRunner
+from dj_phab.management.commands.import_from_phabricator import Command
+from dj_phab.models import ImportWatermark, PullRequest
+from dj_phab.tests import _test_data as test_data
+
+
+class TestImportFromPhabricator(TestCase):
+    def setUp(self):
+        phabricator = test_data.prep_phab_mocks()
+        self.runner = ImportRunner(ConduitAPI(phabricator, 2))
+        # the command would otherwise connect to a real Phabricator
+        patcher = patch.object(Command, 'get_runner', return_value=self.runner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_smoke(self):
+        pass
+
+    def test_import_feed_first_run(self):
+        call_command('import_from_phabricator', feed=True, stdout=StringIO())
+
+        # a regular import, with the feed started from its newest story
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(ImportWatermark.objects.get(entity=ImportWatermark.FEED).cursor,
+                         '6127400442326152519')
+        self.assertIsNotNone(ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS))
+
+    def test_import_feed(self):
+        ImportWatermark.objects.create(entity=ImportWatermark.FEED,
+                                       cursor='6127391856389162311')
+
+        call_command('import_from_phabricator', feed=True, stdout=StringIO())
+
+        self.assertEqual(list(PullRequest.objects.values_list('phab_id', flat=True)), [1466])
+        self.assertEqual(ImportWatermark.objects.get(entity=ImportWatermark.FEED).cursor,
+                         '6127400442326152519')
@@ -1,10 +1,13 @@
 import datetime
 from django.test import TestCase
 from django.utils import timezone
+from mock import patch
 from dj_phab.conduit import ConduitAPI
-from dj_phab.importer import ImportRunner
-from dj_phab.models import PhabUser, Project, Repository, PullRequest
+from dj_phab.importer import ImportRunner, UserImporter
+from dj_phab.models import ImportCheckpoint, ImportWatermark, PhabUser, Project, Repository, \
+                           PullRequest
 from dj_phab.tests import _test_data as test_data
+from phabricator import APIError
 
 class TestImportRunner(TestCase):
     def setUp(self):
@@ -40,4 +43,203 @@ class TestImportRunner(TestCase):
         self.assertEqual(PhabUser.objects.count(), 3)
         self.assertEqual(Project.objects.count(), 5)
         self.assertEqual(Repository.objects.count(), 5)
-        self.assertEqual(PullRequest.objects.count(), 3)
\ No newline at end of file
+        self.assertEqual(PullRequest.objects.count(), 3)
+
+    def test_run_with_watermarks(self):
+        self.runner.run(None)
+        phabricator = self.runner.api.phabricator
+        calls = phabricator.user.query.call_count, phabricator.project.query.call_count
+
+        # nothing has changed since the watermarks
+        ImportWatermark.update_watermarks(timezone.now())
+        self.runner.run(None, watermarks=ImportWatermark.get_watermarks())
+
+        self.assertEqual((phabricator.user.query.call_count,
+                          phabricator.project.query.call_count), calls)
+        self.assertEqual(PhabUser.objects.count(), 3)
+
+    def test_watermarks(self):
+        self.assertEqual(ImportWatermark.get_watermarks(), {})
+
+        now = timezone.now()
+        ImportWatermark.update_watermarks(now, [ImportWatermark.PULL_REQUESTS])
+        self.assertEqual(ImportWatermark.get_watermarks(), {ImportWatermark.PULL_REQUESTS: now})
+        self.assertIsNone(ImportWatermark.get_watermark(ImportWatermark.USERS))
+
+        ImportWatermark.update_watermarks(now)
+        self.assertEqual(len(ImportWatermark.get_watermarks()), len(ImportWatermark.ENTITIES))
+
+    def test_import_feed(self):
+        watermark = ImportWatermark.objects.create(entity=ImportWatermark.FEED,
+                                                   cursor='6127391856389162311')
+
+        self.runner.import_feed(watermark)
+
+        # only the project and diff the newer stories are about, and the diff's relations
+        self.assertEqual(list(Project.objects.values_list('name', flat=True)), ['Initech'])
+        self.assertEqual(list(PullRequest.objects.values_list('phab_id', flat=True)), [1466])
+        self.assertEqual(ImportWatermark.objects.get(entity=ImportWatermark.FEED).cursor,
+                         '6127400442326152519')
+
+    def test_import_feed_up_to_date(self):
+        watermark = ImportWatermark.objects.create(entity=ImportWatermark.FEED,
+                                                   cursor='6127400442326152519')
+
+        self.runner.import_feed(watermark)
+
+        self.assertEqual(PullRequest.objects.count(), 0)
+        self.assertEqual(self.runner.api.phabricator.differential.query.call_count, 0)
+
+    def test_run_batched_files(self):
+        self.runner.run(None)
+
+        self.assertEqual(self.runner.api.phabricator.differential.getcommitpaths.call_count, 0)
+        # one request per batch of 2 diffs
+        self.assertEqual(self.runner.api.phabricator.differential.querydiffs.call_count, 3)
+        for pull_request in PullRequest.objects.all():
+            self.assertEqual(pull_request.files.count(), 4)
+
+    def test_run_concurrent_files(self):
+        runner = ImportRunner(self.runner.api, workers=3, batch_files=False)
+
+        runner.run(None)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(runner.api.phabricator.differential.getcommitpaths.call_count, 5)
+        for pull_request in PullRequest.objects.all():
+            self.assertEqual(pull_request.files.count(), 4)
+
+    def test_rerun_skips_unchanged_files(self):
+        self.runner.run(None)
+        querydiffs = self.runner.api.phabricator.differential.querydiffs
+        self.assertEqual(querydiffs.call_count, 3)
+
+        # push a new version of one diff, and touch the others without new versions
+        original_query = self.runner.api.phabricator.differential.query.side_effect
+        def query_with_new_diff(**kwargs):
+            response = original_query(**kwargs)
+            for diff in response.response:
+                if diff['id'] == '1466':
+                    diff['diffs'] = ['3903'] + diff['diffs']
+            return response
+        self.runner.api.phabricator.differential.query.side_effect = query_with_new_diff
+        querydiffs.reset_mock()
+
+        self.runner.run(None)
+
+        querydiffs.assert_called_once_with(ids=[3903])
+        self.assertEqual(PullRequest.objects.get(phab_id=1466).latest_diff_id, 3903)
+        # unchanged diffs keep their files
+        for pull_request in PullRequest.objects.exclude(phab_id=1466):
+            self.assertEqual(pull_request.files.count(), 4)
+
+    def test_rerun_skips_unchanged_records(self):
+        self.runner.run(None)
+        self.assertEqual(self.runner.stats['users']['created'], 3)
+        self.assertEqual(self.runner.stats['pull requests']['created'], 5)
+
+        self.runner.run(None)
+
+        for name, counts in self.runner.stats.items():
+            self.assertEqual(counts['created'], 0)
+            self.assertEqual(counts['updated'], 0)
+        self.assertEqual(self.runner.stats['users']['skipped'], 3)
+        self.assertEqual(self.runner.stats['pull requests']['skipped'], 5)
+        self.assertIn(u"Users: 0 created, 0 updated, 3 unchanged", self.runner.get_summary())
+
+    def test_run_chunked_resumes(self):
+        query = self.runner.api.phabricator.differential.query
+        original_query = query.side_effect
+        def query_failing_third_page(**kwargs):
+            if kwargs.get('offset') == 4:
+                raise APIError('ERR-CONDUIT-CORE', 'Something broke')
+            return original_query(**kwargs)
+        query.side_effect = query_failing_third_page
+        checkpoint = ImportCheckpoint.get_checkpoint(ImportCheckpoint.PULL_REQUESTS,
+                                                     None, timezone.now())
+
+        with self.assertRaises(APIError):
+            self.runner.run(None, 3, checkpoint)
+
+        # the first chunk (two pages of two diffs) was kept
+        self.assertEqual(PullRequest.objects.count(), 4)
+        checkpoint = ImportCheckpoint.objects.get(entity=ImportCheckpoint.PULL_REQUESTS)
+        self.assertEqual(checkpoint.position, '4')
+
+        query.side_effect = original_query
+        query.reset_mock()
+        self.runner.run(checkpoint.watermark, 3, checkpoint)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual([call[1]['offset'] for call in query.call_args_list], [4])
+
+    def test_run_pipelined(self):
+        runner = ImportRunner(self.runner.api, pipeline={'fetch_workers': 2, 'map_workers': 2,
+                                                         'queue_size': 1})
+
+        runner.run(None)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        for pull_request in PullRequest.objects.all():
+            self.assertEqual(pull_request.files.count(), 4)
+            self.assertIsNotNone(pull_request.author)
+        for name in ('fetch', 'files', 'map', 'write'):
+            self.assertEqual(runner.stage_stats[name].records, 5)
+        self.assertIn(u"Map: 5 records in 3 batches", u"\n".join(runner.get_summary()))
+
+    def test_run_pipelined_chunked(self):
+        runner = ImportRunner(self.runner.api, pipeline={'fetch_workers': 1, 'map_workers': 1,
+                                                         'queue_size': 1})
+        checkpoint = ImportCheckpoint.get_checkpoint(ImportCheckpoint.PULL_REQUESTS,
+                                                     None, timezone.now())
+
+        runner.run(None, 3, checkpoint)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(ImportCheckpoint.objects.get().position, '5')
+
+    def test_missing_relations_inserted_concurrently(self):
+        carol = u'PHID-USER-c0ieboustiagouxlex90'
+        PhabUser.objects.create(phid=carol, user_name='carol', real_name='Carol')
+        find_existing_instances = UserImporter.find_existing_instances
+        searches = []
+        def find_before_insert(phids):
+            # another process inserts carol between the search and the insert
+            searches.append(phids)
+            if len(searches) == 1:
+                return {}
+            return find_existing_instances(phids)
+
+        with patch.object(self.runner.identity_map, 'load'), \
+             patch.object(UserImporter, 'find_existing_instances',
+                          side_effect=find_before_insert):
+            self.runner.import_missing_relations([{'authorPHID': carol}])
+
+        self.assertEqual(len(searches), 2)
+        self.assertEqual(PhabUser.objects.get(phid=carol).real_name, 'Carol Noel')
+        self.assertEqual(self.runner.identity_map.get(PhabUser, carol).user_name, 'carol')
+
+    def test_run_fetches_missing_relations(self):
+        user_query = self.runner.api.phabricator.user.query
+        repo_query = self.runner.api.phabricator.repository.query
+        carol = u'PHID-USER-c0ieboustiagouxlex90'
+        def query_users_without_carol(**kwargs):
+            response = test_data.get_paged_users(**kwargs)
+            if 'phids' not in kwargs:
+                # carol signed up after the users were fetched
+                response.response = [user for user in response.response
+                                     if user['phid'] != carol]
+            return response
+        user_query.side_effect = query_users_without_carol
+
+        self.runner.run(None)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertTrue(PullRequest.objects.filter(author__phid=carol).exists())
+        # carol was fetched on demand, once
+        user_query.assert_called_with(phids=[carol], offset=0, limit=2)
+        self.assertEqual(user_query.call_count, 3)
+        self.assertEqual(self.runner.stats['users']['created'], 3)
+        # all repos were already known
+        for call in repo_query.call_args_list:
+            self.assertNotIn('phids', call[1])
@@ -1,16 +1,71 @@
 import datetime
+from collections import Counter
 from copy import deepcopy
+from django.db import connection, IntegrityError, models
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
+from mock import patch
+from unittest import skipUnless
 from dj_phab.models import PhabUser, Project, Repository, PullRequest, UpdatedFile
 from dj_phab.importer import UserImporter, ProjectImporter, RepositoryImporter, \
-                             PullRequestImporter, UpdatedFileImporter
+                             PullRequestImporter, UpdatedFileImporter, IdentityMap, \
+                             RelationNotImportedError, convert_timestamp
 
 # Create your tests here.
 class TestImporter(TestCase):
     def test_smoke(self):
         pass
 
+    def test_converters_compiled_once_per_class(self):
+        user_converters = UserImporter.get_converters()
+
+        self.assertIs(UserImporter.get_converters(), user_converters)
+        self.assertItemsEqual([name for name, is_m2m, convert in user_converters],
+                              UserImporter.field_map.keys())
+        self.assertItemsEqual([name for name, is_m2m, convert in ProjectImporter.get_converters()],
+                              ProjectImporter.field_map.keys())
+
+    def test_convert_timestamp(self):
+        self.assertEqual(convert_timestamp(u'1414515472'),
+                         datetime.datetime(2014, 10, 28, 16, 57, 52, tzinfo=timezone.utc))
+
+    @override_settings(TIME_ZONE='America/New_York')
+    def test_convert_timestamp_in_dst_change(self):
+        # 1:30am on the day New York's clocks go back, which happens twice in local time
+        self.assertEqual(convert_timestamp(1414906200),
+                         datetime.datetime(2014, 11, 2, 5, 30, tzinfo=timezone.utc))
+
+    def test_converters_flag_m2ms(self):
+        m2m_names = [name for name, is_m2m, convert in PullRequestImporter.get_converters()
+                     if is_m2m]
+        self.assertItemsEqual(m2m_names, ['files', 'reviewers'])
+
+
+class TestIdentityMap(TestCase):
+    def setUp(self):
+        self.identity_map = IdentityMap()
+        self.users = UserImporter.convert_records([TestUserImporter.noemi_dict,
+                                                   TestUserImporter.luke_dict])
+
+    def test_smoke(self):
+        pass
+
+    def test_get_added(self):
+        self.identity_map.add(self.users)
+
+        with self.assertNumQueries(0):
+            luke = self.identity_map.get(PhabUser, u'PHID-USER-123')
+        self.assertEqual(luke.user_name, 'luke')
+
+    def test_load_once(self):
+        with self.assertNumQueries(1):
+            self.identity_map.load(PhabUser, [u'PHID-USER-123', u'PHID-USER-7ij7ij7ij7ij7ij7ij7i',
+                                              u'PHID-USER-nobody'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.identity_map.get(PhabUser, u'PHID-USER-123').user_name, 'luke')
+            self.assertIsNone(self.identity_map.get(PhabUser, u'PHID-USER-nobody'))
+
 
 class TestUserImporter(TestCase):
     noemi_dict = {
@@ -61,6 +116,58 @@ class TestUserImporter(TestCase):
         self.assertEqual(noemi.real_name, 'Noemi Millman')
         self.assertEqual(luke.real_name, 'Luke Skywalker')
 
+    def test_convert_records_in_bulk(self):
+        # one query to find existing users, one to insert, one to load the new rows
+        with self.assertNumQueries(3):
+            UserImporter.convert_records([self.noemi_dict, self.luke_dict, self.obiwan_dict])
+
+        self.assertEqual(PhabUser.objects.count(), 3)
+
+    def test_convert_records_updates_existing(self):
+        UserImporter.convert_records([self.noemi_dict, self.luke_dict])
+        renamed_luke = dict(self.luke_dict, realName=u'Luke Organa')
+
+        users = UserImporter.convert_records([renamed_luke, self.obiwan_dict])
+
+        self.assertEqual(PhabUser.objects.count(), 3)
+        self.assertEqual(PhabUser.objects.get(user_name='luke').real_name, 'Luke Organa')
+        self.assertTrue(all(user.pk for user in users))
+
+    def test_convert_records_skips_unchanged(self):
+        UserImporter.convert_records([self.noemi_dict, self.luke_dict])
+        renamed_luke = dict(self.luke_dict, realName=u'Luke Organa')
+        stats = Counter()
+
+        # one query to find existing users, one to update luke
+        with self.assertNumQueries(2):
+            UserImporter.convert_records([self.noemi_dict, renamed_luke], stats=stats)
+
+        self.assertEqual(stats['created'], 0)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['skipped'], 1)
+
+    @skipUnless(hasattr(models, 'Case'), "Django 1.7 updates changed rows one at a time")
+    def test_convert_records_updates_in_bulk(self):
+        UserImporter.convert_records([self.noemi_dict, self.luke_dict, self.obiwan_dict])
+        renamed = [dict(self.noemi_dict, realName=u'Noemi M.'),
+                   dict(self.luke_dict, realName=u'Luke Organa'),
+                   dict(self.obiwan_dict, realName=u'Ben Kenobi')]
+
+        # one query to find existing users, one to update all of them
+        with self.assertNumQueries(2):
+            UserImporter.convert_records(renamed)
+
+        self.assertItemsEqual(PhabUser.objects.values_list('real_name', flat=True),
+                              [u'Noemi M.', u'Luke Organa', u'Ben Kenobi'])
+
+    def test_convert_records_duplicate_phids(self):
+        renamed_luke = dict(self.luke_dict, realName=u'Luke Organa')
+
+        UserImporter.convert_records([self.luke_dict, renamed_luke])
+
+        self.assertEqual(PhabUser.objects.count(), 1)
+        self.assertEqual(PhabUser.objects.get(user_name='luke').real_name, 'Luke Organa')
+
 
 class TestProjectImporter(TestCase):
     proj_1_dict = {
@@ -189,6 +296,32 @@ class TestUpdatedFileImporter(TestCase):
         hammers = UpdatedFile.objects.filter(filename__contains='hammers')
         self.assertEqual(hammers.count(), 2)
 
+    def test_intern(self):
+        UpdatedFileImporter('assets/anvil/campaign/views/hammers.assets').convert_record()
+        known_ids = {}
+
+        # one query to find existing files, one to insert (wrapped in a savepoint), one to
+        # find new IDs
+        with self.assertNumQueries(5):
+            file_ids = UpdatedFileImporter.intern(self.file_list + self.file_list[:1], known_ids)
+
+        self.assertEqual(UpdatedFile.objects.count(), 4)
+        self.assertEqual(known_ids, file_ids)
+        for filename in self.file_list:
+            self.assertEqual(UpdatedFile.objects.get(pk=file_ids[filename]).filename, filename)
+
+        # known files cost nothing
+        with self.assertNumQueries(0):
+            UpdatedFileImporter.intern(self.file_list[:2], known_ids)
+
+    def test_intern_concurrent_insert(self):
+        # simulate another import inserting the same files between our lookup and insert
+        with patch.object(UpdatedFile.objects, 'bulk_create', side_effect=IntegrityError):
+            file_ids = UpdatedFileImporter.intern(self.file_list)
+
+        self.assertEqual(UpdatedFile.objects.count(), 4)
+        self.assertItemsEqual(file_ids.keys(), self.file_list)
+
 
 class TestPullRequestImporter(TestCase):
     diff_1_dict = {
@@ -271,3 +404,70 @@ class TestPullRequestImporter(TestCase):
         self.assertEqual(updated.status, PullRequest.STATUS.abandoned)
         reviewer_usernames = [reviewer.user_name for reviewer in updated.reviewers.all()]
         self.assertItemsEqual(reviewer_usernames, ['noemi', 'obiwan',])
+
+    def test_convert_records_uses_identity_map(self):
+        identity_map = IdentityMap()
+        identity_map.add(PhabUser.objects.all())
+        identity_map.add(Repository.objects.all())
+        other_diff = dict(self.diff_1_dict, id=u'629', phid=u'PHID-DREV-629',
+                          authorPHID=u'PHID-USER-987')
+
+        with CaptureQueriesContext(connection) as queries:
+            PullRequestImporter.convert_records([self.diff_1_dict, other_diff], identity_map)
+
+        self.assertEqual(PullRequest.objects.count(), 2)
+        for query in queries.captured_queries:
+            self.assertNotIn('FROM "dj_phab_phabuser"', query['sql'])
+            self.assertNotIn('FROM "dj_phab_repository"', query['sql'])
+
+    def test_missing_relation(self):
+        orphan_diff = dict(self.diff_1_dict, authorPHID=u'PHID-USER-nobody')
+
+        with self.assertRaises(RelationNotImportedError):
+            PullRequestImporter.convert_records([orphan_diff])
+
+    def test_convert_records_updates_fields_in_bulk(self):
+        PullRequestImporter.convert_records([self.diff_1_dict])
+        updated_diff = dict(self.diff_1_dict, title=u'Change More Stuff', status=u'2',
+                            authorPHID=u'PHID-USER-7ij7ij7ij7ij7ij7ij7i',
+                            dateModified=u'1414600000')
+
+        PullRequestImporter.convert_records([updated_diff])
+
+        change = PullRequest.objects.get(phab_id=628)
+        self.assertEqual(change.title, u'Change More Stuff')
+        self.assertEqual(change.status, 2)
+        self.assertEqual(change.author.user_name, 'noemi')
+        self.assertEqual(change.date_updated, convert_timestamp(u'1414600000'))
+
+    def test_convert_records_syncs_m2m_deltas(self):
+        through = PullRequest.reviewers.through
+        PullRequestImporter.convert_records([self.diff_1_dict])
+        noemi_row = through.objects.get(phabuser__user_name='noemi')
+
+        updated_diff = deepcopy(self.diff_1_dict)
+        updated_diff['reviewers'] = [u'PHID-USER-7ij7ij7ij7ij7ij7ij7i', u'PHID-USER-987',]
+        PullRequestImporter.convert_records([updated_diff])
+
+        change = PullRequest.objects.get(phab_id=628)
+        self.assertItemsEqual([reviewer.user_name for reviewer in change.reviewers.all()],
+                              ['noemi', 'obiwan'])
+        # the unchanged reviewer's row was left alone rather than rewritten
+        self.assertEqual(through.objects.get(phabuser__user_name='noemi').pk, noemi_row.pk)
+
+    def test_map_records(self):
+        with CaptureQueriesContext(connection) as queries:
+            mapped = PullRequestImporter.map_records([self.diff_1_dict])
+
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(mapped[0]['line_count'], 21)
+        self.assertEqual(mapped[0]['latest_diff_id'], 1578)
+        # relations are left to convert_records
+        for name in ('author', 'repository', 'reviewers', 'files'):
+            self.assertNotIn(name, mapped[0])
+
+        PullRequestImporter.convert_records([self.diff_1_dict], mapped=mapped)
+
+        change = PullRequest.objects.get(phab_id=628)
+        self.assertEqual(change.line_count, 21)
+        self.assertEqual(change.author.user_name, 'luke')
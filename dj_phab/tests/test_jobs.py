@@ -0,0 +1,115 @@
+from django.test import TestCase
+from mock import MagicMock, patch
+from dj_phab.conduit import ConduitAPI
+from dj_phab.importer import convert_timestamp, ImportRunner, PullRequestImporter
+from dj_phab.jobs import MAX_ATTEMPTS, queue_import, run_worker
+from dj_phab.models import ImportJob, ImportWatermark, PullRequest, UpdatedFile
+from dj_phab.tests import _test_data as test_data
+from phabricator import APIError
+
+
+class TestJobs(TestCase):
+    def setUp(self):
+        phabricator = test_data.prep_phab_mocks()
+        # with cursor pagination only the IDs of diffs are listed when queueing
+        conduit = ConduitAPI(phabricator, 2, pagination='cursor')
+        self.runner = ImportRunner(conduit)
+
+    def test_smoke(self):
+        pass
+
+    def test_queue_import(self):
+        jobs = queue_import(self.runner, {})
+
+        # every page of diffs is queued up front
+        self.assertEqual(len(jobs), 3)
+        self.assertEqual(ImportJob.objects.count(), 3)
+        self.assertEqual(sum(len(job.get_payload()['ids']) for job in ImportJob.objects.all()),
+                         5)
+        # an import is already queued
+        self.assertIsNone(queue_import(self.runner, {}))
+
+    def test_queue_import_by_offset(self):
+        self.runner.api.pagination = 'offset'
+
+        jobs = queue_import(self.runner, {})
+
+        self.assertEqual([job.get_payload()['ids'] for job in jobs],
+                         [[1466, 1465], [1464, 1463], [1462]])
+
+    def test_queue_import_unchanged(self):
+        ImportWatermark.update_watermarks(convert_timestamp('1500000000'))
+
+        self.assertEqual(queue_import(self.runner, ImportWatermark.get_watermarks()), [])
+
+        # nothing to do, so the import is already complete
+        self.assertGreater(ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS),
+                           convert_timestamp('1500000000'))
+
+    def test_run_worker(self):
+        queue_import(self.runner, {})
+
+        self.assertEqual(run_worker(self.runner, 'a', 600), 3)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertIsNotNone(ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS))
+
+    def test_run_worker_waits_for_other_workers(self):
+        queue_import(self.runner, {})
+        other = ImportJob.claim('b', 600)
+        def sleep(seconds):
+            # the other worker finishes its job while this one waits
+            self.runner.run_job(other)
+            other.finish()
+        sleep = MagicMock(side_effect=sleep)
+
+        self.assertEqual(run_worker(self.runner, 'a', 600, sleep=sleep), 2)
+
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(PullRequest.objects.count(), 5)
+
+    def test_run_worker_retries_failures(self):
+        queue_import(self.runner, {})
+        self.runner.api.phabricator.differential.query.side_effect = \
+            APIError('ERR-CONDUIT-CORE', 'Something broke')
+
+        self.assertEqual(run_worker(self.runner, 'a', 600, retry_delay=0), 0)
+
+        for job in ImportJob.objects.all():
+            self.assertEqual(job.status, ImportJob.STATUS.failed)
+            self.assertEqual(job.attempts, MAX_ATTEMPTS)
+            self.assertIn('Something broke', job.error)
+        self.assertIsNone(ImportWatermark.get_watermark(ImportWatermark.PULL_REQUESTS))
+
+    def test_failed_job_resets_caches(self):
+        queue_import(self.runner, {})
+        convert_records = PullRequestImporter.convert_records
+        calls = []
+        def fail_first_job(*args, **kwargs):
+            # after the job's files and users are saved, so that they're rolled back
+            calls.append(1)
+            if len(calls) == 1:
+                raise APIError('ERR-CONDUIT-CORE', 'Something broke')
+            return convert_records(*args, **kwargs)
+
+        with patch.object(PullRequestImporter, 'convert_records', side_effect=fail_first_job):
+            run_worker(self.runner, 'a', 600, retry_delay=0)
+
+        self.assertEqual(PullRequest.objects.count(), 5)
+        self.assertEqual(set(PullRequest.files.through.objects.values_list('updatedfile_id',
+                                                                           flat=True)),
+                         set(UpdatedFile.objects.values_list('pk', flat=True)))
+
+    def test_failed_job_backs_off(self):
+        queue_import(self.runner, {})
+        job = ImportJob.claim('a', 600)
+
+        job.fail('Something broke', MAX_ATTEMPTS, retry_delay=30)
+
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ImportJob.STATUS.pending)
+        self.assertIsNotNone(job.retry_after)
+        # the other jobs are claimed, but not the failed one until it's due
+        self.assertNotEqual(ImportJob.claim('b', 600), job)
+        self.assertNotEqual(ImportJob.claim('b', 600), job)
+        self.assertIsNone(ImportJob.claim('b', 600))
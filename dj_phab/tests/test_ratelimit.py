@@ -0,0 +1,72 @@
+from django.test import TestCase
+from mock import MagicMock
+from dj_phab.conduit import ConduitAPI
+from dj_phab.ratelimit import RateLimiter, TokenBucket
+from dj_phab.tests import _test_data as test_data
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sleep = MagicMock(side_effect=self.clock.sleep)
+        self.bucket = TokenBucket(2, burst=2, clock=self.clock, sleep=self.sleep)
+
+    def test_smoke(self):
+        pass
+
+    def test_burst_is_free(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.assertEqual(self.sleep.call_count, 0)
+
+    def test_waits_for_tokens(self):
+        for i in range(6):
+            self.bucket.acquire()
+
+        # 2 tokens up front, then 4 more at 2 per second
+        self.assertAlmostEqual(self.clock.now, 1002.0)
+
+    def test_refills_over_time(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.clock.now += 1
+
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertAlmostEqual(self.bucket.reserve(), 0.5)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+
+class TestRateLimiter(TestCase):
+    def test_smoke(self):
+        pass
+
+    def test_per_method_buckets(self):
+        limiter = RateLimiter({'default': 5, 'differential.getcommitpaths': 1})
+
+        self.assertIsNot(limiter.buckets['differential.getcommitpaths'],
+                         limiter.buckets['default'])
+        self.assertEqual(limiter.buckets['differential.getcommitpaths'].rate, 1)
+
+    def test_conduit_acquires_per_call(self):
+        limiter = RateLimiter()
+        limiter.acquire = MagicMock()
+        conduit = ConduitAPI(test_data.prep_phab_mocks(), 2, rate_limiter=limiter)
+
+        conduit.fetch_files(123)
+
+        limiter.acquire.assert_called_once_with('differential.getcommitpaths')
@@ -0,0 +1,133 @@
+import socket
+from django.test import TestCase
+from mock import MagicMock
+from phabricator import APIError
+from dj_phab.conduit import ConduitAPI
+from dj_phab.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from dj_phab.tests import _test_data as test_data
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRetryPolicy(TestCase):
+    def setUp(self):
+        self.sleep = MagicMock()
+        self.policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=1.5,
+                                  failure_threshold=100, sleep=self.sleep)
+
+    def test_smoke(self):
+        pass
+
+    def test_retries_transient_errors(self):
+        func = MagicMock(side_effect=[socket.timeout(), socket.error(), 'ok'])
+
+        self.assertEqual(self.policy.call(func), 'ok')
+
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        for call in self.sleep.call_args_list:
+            self.assertTrue(0 <= call[0][0] <= 1.5)
+
+    def test_gives_up_after_max_attempts(self):
+        func = MagicMock(side_effect=socket.timeout())
+
+        with self.assertRaises(socket.timeout):
+            self.policy.call(func)
+
+        self.assertEqual(func.call_count, 3)
+
+    def test_does_not_retry_api_errors(self):
+        func = MagicMock(side_effect=APIError('ERR-CONDUIT-CORE', 'Bad request'))
+
+        with self.assertRaises(APIError):
+            self.policy.call(func)
+
+        self.assertEqual(func.call_count, 1)
+
+    def test_conduit_retries_every_method(self):
+        phabricator = test_data.prep_phab_mocks()
+        phabricator.differential.getcommitpaths.side_effect = [socket.timeout(),
+                                                               test_data.get_dummy_files()]
+        conduit = ConduitAPI(phabricator, 2, retry_policy=self.policy)
+
+        self.assertEqual(len(conduit.fetch_files(123)), 4)
+        self.assertEqual(phabricator.differential.getcommitpaths.call_count, 2)
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=self.clock)
+
+    def test_smoke(self):
+        pass
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.breaker.record_failure()
+
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+
+        self.assertFalse(self.breaker.is_open)
+
+    def test_half_open_after_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        self.clock.now += 61
+        # trial call is allowed through...
+        self.breaker.before_call()
+        # ...and a single failure reopens the circuit
+        self.breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_half_open_allows_single_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        self.clock.now += 61
+        self.breaker.before_call()
+        # other callers keep failing fast while the trial call is in progress...
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+        # ...until it succeeds
+        self.breaker.record_success()
+        self.breaker.before_call()
+        self.breaker.before_call()
+
+    def test_non_transient_error_ends_trial(self):
+        policy = RetryPolicy(failure_threshold=1, reset_timeout=60)
+        policy.circuit_breaker.clock = self.clock
+        policy.circuit_breaker.record_failure()
+        self.clock.now += 61
+
+        with self.assertRaises(ValueError):
+            policy.call(MagicMock(side_effect=ValueError()))
+
+        self.assertFalse(policy.circuit_breaker.is_open)
+
+    def test_open_circuit_stops_retries(self):
+        sleep = MagicMock()
+        policy = RetryPolicy(max_attempts=10, failure_threshold=2, sleep=sleep)
+        func = MagicMock(side_effect=socket.timeout())
+
+        with self.assertRaises(CircuitOpenError):
+            policy.call(func)
+
+        self.assertEqual(func.call_count, 2)
@@ -0,0 +1,122 @@
+import json
+import threading
+from django.test import TestCase
+from mock import MagicMock, patch
+from phabricator import APIError
+from django.utils.six.moves import BaseHTTPServer, http_client
+from dj_phab.conduit import ConduitAPI
+from dj_phab.transport import PooledHTTPTransport
+
+
+def make_response(result=None, status=200, error_code=None):
+    response = MagicMock()
+    response.status = status
+    response.read.return_value = json.dumps({
+        'result': result,
+        'error_code': error_code,
+        'error_info': 'Something went wrong' if error_code else None,
+    })
+    return response
+
+
+class DroppingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request, then closes the connection without saying so, as a server does
+    when a keep-alive connection times out while idle
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        body = json.dumps({'result': self.server.requests, 'error_code': None})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledHTTPTransport(TestCase):
+    def setUp(self):
+        self.phabricator = MagicMock()
+        self.phabricator.host = 'https://phab.example.com/api/'
+        self.phabricator.timeout = 5
+        self.phabricator._conduit = {'token': 'api-abc123'}
+
+        patcher = patch('dj_phab.transport.http_client.HTTPSConnection')
+        self.connection_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = self.connection_class.return_value
+
+        self.transport = PooledHTTPTransport(self.phabricator, pool_size=2)
+
+    def test_smoke(self):
+        pass
+
+    def test_reuses_connections(self):
+        self.connection.getresponse.side_effect = [make_response(['a.py']),
+                                                   make_response(['b.py'])]
+
+        self.assertEqual(self.transport.call('differential.getcommitpaths', {'revision_id': 1}),
+                         ['a.py'])
+        self.assertEqual(self.transport.call('differential.getcommitpaths', {'revision_id': 2}),
+                         ['b.py'])
+
+        self.assertEqual(self.connection_class.call_count, 1)
+        method, path, body, headers = self.connection.request.call_args[0]
+        self.assertEqual(path, '/api/differential.getcommitpaths')
+        self.assertIn('api-abc123', body)
+
+    def test_api_error(self):
+        self.connection.getresponse.return_value = make_response(error_code='ERR-CONDUIT-CORE')
+
+        with self.assertRaises(APIError):
+            self.transport.call('user.query', {})
+
+    def test_discards_failed_connections(self):
+        self.connection.getresponse.side_effect = [make_response(status=502),
+                                                   make_response([])]
+
+        with self.assertRaises(http_client.HTTPException):
+            self.transport.call('user.query', {})
+        self.transport.call('user.query', {})
+
+        self.assertEqual(self.connection.close.call_count, 1)
+        self.assertEqual(self.connection_class.call_count, 2)
+
+    def test_conduit_uses_transport(self):
+        self.connection.getresponse.return_value = make_response(['a.py', 'b.py'])
+        conduit = ConduitAPI(self.phabricator, 2, transport=self.transport)
+
+        self.assertEqual(conduit.fetch_files(123), ['a.py', 'b.py'])
+
+
+class TestPooledHTTPTransportServer(TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), DroppingHandler)
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        phabricator = MagicMock()
+        phabricator.host = 'http://127.0.0.1:%s/api/' % self.server.server_port
+        phabricator.timeout = 5
+        phabricator._conduit = {'token': 'api-abc123'}
+        self.transport = PooledHTTPTransport(phabricator, pool_size=2)
+
+    def test_smoke(self):
+        pass
+
+    def test_retries_dropped_connection(self):
+        self.assertEqual(self.transport.call('user.query', {}), 1)
+        # the pooled connection was dropped by the server, so a new one is used
+        self.assertEqual(self.transport.call('user.query', {}), 2)
+        self.assertEqual(self.server.requests, 2)
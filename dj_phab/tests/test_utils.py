@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.test import TestCase
-from dj_phab.util import consolidate_time_period, annotate_dict
+from dj_phab.util import consolidate_time_period, annotate_dict, chunks
 
 
 class TestTimePeriod(TestCase):
@@ -41,3 +41,12 @@ class TestTimePeriod(TestCase):
         annotate_dict(entries, 'c', new_data, 'd')
 
         self.assertDictEqual(entries, expected)
+
+
+class TestChunks(TestCase):
+    def test_smoke(self):
+        pass
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+        self.assertEqual(list(chunks([], 2)), [])
@@ -0,0 +1,149 @@
+"""
+Transports used by `ConduitAPI` to send requests to Conduit
+"""
+import json
+import socket
+import threading
+from django.utils.six.moves import http_client, queue as Queue
+from django.utils.six.moves.urllib.parse import urlencode, urlparse
+from phabricator import APIError
+
+
+class PhabricatorTransport(object):
+    """
+    Sends requests through the `python-phabricator` client itself, which opens a new
+    connection for every request
+    """
+
+    def __init__(self, phabricator, **kwargs):
+        """
+        @param Phabricator phabricator A python-phabricator API client
+        """
+        super(PhabricatorTransport, self).__init__(**kwargs)
+        self.phabricator = phabricator
+
+    def call(self, method, params):
+        """
+        @param str method Conduit method name, e.g. 'differential.query'
+        @param dict params
+        @return any The method's result
+        """
+        resource = self.phabricator
+        for name in method.split('.'):
+            resource = getattr(resource, name)
+
+        return resource(**params).response
+
+    def close(self):
+        """
+        Nothing to close, as connections aren't kept between requests
+        """
+
+
+class PooledHTTPTransport(object):
+    """
+    Sends requests over persistent (keep-alive) HTTP connections, reusing the host and
+    credentials of a `python-phabricator` client.  Up to ``pool_size`` connections are
+    shared between threads; callers block while all of them are in use.  A request that
+    fails before any response on a reused connection, e.g. one the server closed while it
+    was idle, is sent again on a new connection.
+    """
+
+    def __init__(self, phabricator, pool_size=4, **kwargs):
+        """
+        @param Phabricator phabricator A python-phabricator API client, used for its
+            configuration and to authenticate
+        @param int pool_size Maximum number of open connections
+        """
+        super(PooledHTTPTransport, self).__init__(**kwargs)
+        self.phabricator = phabricator
+        self.pool_size = pool_size
+        self.url = urlparse(phabricator.host)
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._auth_lock = threading.Lock()
+
+    def new_connection(self):
+        if self.url.scheme == 'https':
+            connection_class = http_client.HTTPSConnection
+        else:
+            connection_class = http_client.HTTPConnection
+        return connection_class(self.url.netloc, timeout=self.phabricator.timeout)
+
+    def get_conduit_auth(self):
+        with self._auth_lock:
+            if not self.phabricator._conduit:
+                self.phabricator.connect()
+            return self.phabricator._conduit
+
+    def call(self, method, params):
+        """
+        @param str method Conduit method name, e.g. 'differential.query'
+        @param dict params
+        @return any The method's result
+        """
+        params = dict(params, __conduit__=self.get_conduit_auth())
+        body = urlencode({
+            'params': json.dumps(params),
+            'output': 'json',
+        })
+        headers = {
+            'User-Agent': 'django-phabricator',
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive',
+        }
+
+        self._slots.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                connection = self.new_connection()
+                reused = False
+
+            try:
+                try:
+                    connection.request('POST', self.url.path + method, body, headers)
+                    response = connection.getresponse()
+                except socket.timeout:
+                    raise
+                except (socket.error, http_client.HTTPException):
+                    if not reused:
+                        raise
+                    # The server may have closed the connection while it was idle, so
+                    # try once more on a new one
+                    connection.close()
+                    connection = self.new_connection()
+                    connection.request('POST', self.url.path + method, body, headers)
+                    response = connection.getresponse()
+                # the whole response must be read before the connection can be reused
+                data = response.read()
+                if not 200 <= response.status < 300:
+                    raise http_client.HTTPException(
+                        'Bad response status: %s' % response.status)
+            except Exception:
+                # the connection may be in any state, so don't reuse it
+                connection.close()
+                raise
+
+            self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+        if not isinstance(data, str):
+            data = data.decode('utf-8')
+        parsed = json.loads(data)
+        if parsed.get('error_code'):
+            raise APIError(parsed['error_code'], parsed['error_info'])
+        return parsed['result']
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
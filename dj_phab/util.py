@@ -87,3 +87,19 @@ def annotate_dict(entries, add_key, new_data, new_data_key):
         # and insert the entry into entries if it doesn't already exist
         if not entry_exists:
             entries[top_key] = entry
+
+
+def chunks(items, size):
+    """
+    Split a list into consecutive lists of at most ``size`` items
+
+    Example:
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+
+    @param list items
+    @param int size
+    @return generator<list>
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]